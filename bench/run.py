@@ -0,0 +1,442 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import resource
+import subprocess as sp
+import multiprocessing
+
+from .synth import Synth
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+STUB_DIR = os.path.join(BENCH_DIR, 'stubs')
+
+SCALES = {
+        'small': {'cells': 200, 'taxa': 500, 'reads': 50000},
+        'medium': {'cells': 5000, 'taxa': 2000, 'reads': 2000000, 'fq_reads': 1000000},
+        # about one production sample
+        'large': {'cells': 50000, 'taxa': 5000, 'reads': 20000000, 'fq_reads': 10000000},
+        }
+# bracken as the pipeline runs it by default, --braken-mode native times the in-process engine instead
+BRAKEN_MODE = 'external'
+
+
+def base_config(synth, outdir, process):
+    return {
+            'sample': synth.sample,
+            'outdir': outdir,
+            'process': str(process),
+            'krakenDb': synth.kdb,
+            'kraken': os.path.join(STUB_DIR, 'kraken2'),
+            'braken': os.path.join(STUB_DIR, 'bracken'),
+            'nubeam_dedup': os.path.join(STUB_DIR, 'nubeam-dedup'),
+            'braken_mode': BRAKEN_MODE,
+            'batch_rollup': 'on',
+            'braken_store': 'on',
+            'filter_threshold': '10',
+            }
+
+
+def scratch(synth, name):
+    # cases that write a project of their own get a fresh directory next to the synthetic one
+    outdir = os.path.join(synth.root, 'runs', name)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+    return outdir
+
+
+# every case sets up its inputs and returns the timed work, which returns the number of records it handled
+
+def case_taxonomy(synth, process):
+    from libs.classify import Taxanomy
+
+    def run():
+        return len(Taxanomy(synth.kreport).tax_ids)
+    return run
+
+
+def case_taxonomy_query(synth, process, queries=100000):
+    # lineage, clade membership and LCA of the tax_ids of the first reads, as downstream analyses ask them
+    import numpy as np
+    from libs.classify import Taxanomy
+    taxan = Taxanomy(synth.kreport)
+    with open(synth.koutput) as fh:
+        tax_ids = np.array([line.split('\t', 3)[2] for line, _ in zip(fh, range(queries))])
+
+    def run():
+        taxan.lineage(tax_ids)
+        taxan.within(tax_ids, '1')
+        taxan.lca(tax_ids, tax_ids[::-1])
+        taxan.lca_all(tax_ids)
+        return tax_ids.size
+    return run
+
+
+def case_koutput(synth, process):
+    from libs.koutput import read_kraken_output
+
+    def run():
+        return int(read_kraken_output(synth.koutput, process).matrix.sum())
+    return run
+
+
+def case_koutput_cache(synth, process):
+    # a later run reading the binary cache the first parse left next to the kraken output
+    from libs.koutput import load_kraken_output
+    load_kraken_output(synth.koutput, process)
+
+    def run():
+        return int(load_kraken_output(synth.koutput, process).matrix.sum())
+    return run
+
+
+def classifier(synth, process, name):
+    from libs.classify import Classifier
+    from libs.koutput import read_kraken_output
+    outdir = scratch(synth, name)
+    obj = Classifier(base_config(synth, outdir, process), synth.kreport)
+    return obj, read_kraken_output(synth.koutput, process)
+
+
+def case_cell_taxan(synth, process):
+    obj, bc_counts = classifier(synth, process, 'cell_taxan')
+
+    def run():
+        for i in range(len(bc_counts)):
+            obj.cell_taxan(bc_counts.cell(i))
+        return len(bc_counts)
+    return run
+
+
+def case_batch_rollup(synth, process):
+    obj, bc_counts = classifier(synth, process, 'batch_rollup')
+
+    def run():
+        obj.batch_rollup(bc_counts)
+        for i in range(len(bc_counts)):
+            obj.batch_taxan(i)
+        return len(bc_counts)
+    return run
+
+
+def case_bracken(synth, process):
+    from libs.bracken import Bracken
+    obj, bc_counts = classifier(synth, process, 'bracken')
+    obj.batch_rollup(bc_counts)
+    n = len(bc_counts)
+
+    def run():
+        engine = Bracken(obj.taxan, synth.kdb)
+        direct = obj.block_rows('direct', 0, n)
+        clade = obj.block_rows('clade', 0, n)
+        return sum(1 for level in ('S', 'G') for _ in engine.reports(direct, clade, level))
+    return run
+
+
+def case_classify(synth, process):
+    from libs.classify import Classifier
+    outdir = scratch(synth, 'classify')
+    obj = Classifier(base_config(synth, outdir, process), synth.kreport)
+
+    def run():
+        obj.worker_pool(synth.koutput)
+        return len(obj.barcodes)
+    return run
+
+
+def report(synth, process, store):
+    from libs.report import Report
+    config = base_config(synth, synth.root, process)
+    config['braken_store'] = 'on' if store else 'off'
+    return Report(config)
+
+
+def case_count_matrix(synth, process):
+    import pandas as pd
+    from libs.matrix import CountMatrix
+    barcodes, species = report(synth, process, True).braken_table('S')
+    outdir = scratch(synth, 'count_matrix')
+
+    def run():
+        codes, features = pd.factorize(species['name'].str.replace(' ', '_'))
+        matrix = CountMatrix.from_arrays(codes, species['cell'].values, species['new_est_reads'].values, features, barcodes)
+        matrix.save_mex(outdir, 6, process)
+        matrix.save_binary(outdir)
+        return int(matrix.m.nnz)
+    return run
+
+
+def case_rank_matrix(synth, process):
+    from libs.rankmatrix import RankMatrix
+    config = base_config(synth, scratch(synth, 'rank_matrix'), process)
+    config['matrix_ranks'] = 'S,G,F,O'
+    obj = RankMatrix(config, synth.kreport)
+
+    def run():
+        obj.run(synth.koutput)
+        return synth.reads
+    return run
+
+
+def case_report_files(synth, process):
+    obj = report(synth, process, False)
+
+    def run():
+        obj.report()
+        return synth.cells
+    return run
+
+
+def case_report_store(synth, process):
+    obj = report(synth, process, True)
+
+    def run():
+        obj.report()
+        return synth.cells
+    return run
+
+
+def case_report_cells(synth, process):
+    # --report re-analysis at three cell numbers, after one full report
+    obj = report(synth, process, True)
+    obj.report()
+    cell_nums = [max(synth.cells * k // 4, 1) for k in (1, 2, 3)]
+
+    def run():
+        obj.report_cells(cell_nums)
+        return sum(cell_nums)
+    return run
+
+
+def case_merge_fastq(synth, process):
+    from libs.dedup import Dedup
+    from libs.fastq import merge_fastq
+    outdir = scratch(synth, 'merge_fastq')
+
+    def run():
+        dedup = Dedup(outdir)
+        merge_fastq(synth.fq1, synth.fq2, os.path.join(outdir, 'dedup.fq'), process, dedup=dedup)
+        dedup.close()
+        return dedup.reads
+    return run
+
+
+def case_pipeline(synth, process):
+    # preflight to report end to end, kraken2 and nubeam-dedup replaced by the stubs
+    from libs.cli import run_stages
+    from libs.preflight import PreFlight
+    outdir = scratch(synth, 'pipeline')
+    os.makedirs(os.path.join(outdir, 'clean_data'))
+    for fq in (synth.fq1, synth.fq2):
+        os.symlink(fq, os.path.join(outdir, 'clean_data', os.path.basename(fq)))
+    config = base_config(synth, outdir, process)
+    config['cell_num'] = str(synth.cells)
+
+    def run():
+        run_stages(config, PreFlight(config))
+        return synth.fq_reads
+    return run
+
+
+# modules the cli must not load before a stage needs them
+HEAVY_MODULES = ('pandas', 'matplotlib', 'seaborn', 'pyfastx', 'scipy.stats', 'scipy.ndimage')
+STARTUP = """
+import sys, time
+start = time.time()
+import {module}
+print(time.time() - start)
+print(','.join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def case_startup(synth, process, runs=5):
+    # import time of the cli and of a classifier worker started by spawn, in fresh interpreters
+    root = os.path.dirname(BENCH_DIR)
+
+    def run():
+        for module in ('libs.cli', 'libs.classify'):
+            times = []
+            for i in range(runs):
+                out = sp.run([sys.executable, '-c', STARTUP.format(module=module, heavy=HEAVY_MODULES)],
+                        cwd=root, capture_output=True, text=True, check=True).stdout.split('\n')
+                times.append(float(out[0]))
+                if out[1]:
+                    raise RuntimeError(f'importing {module} loads {out[1]}')
+            print(f'startup: {module} imports in {sorted(times)[runs // 2]:.3f}s', file=sys.stderr)
+        return 2 * runs
+    return run
+
+
+CASES = {
+        'startup': case_startup,
+        'taxonomy': case_taxonomy,
+        'taxonomy_query': case_taxonomy_query,
+        'koutput': case_koutput,
+        'koutput_cache': case_koutput_cache,
+        'cell_taxan': case_cell_taxan,
+        'batch_rollup': case_batch_rollup,
+        'bracken': case_bracken,
+        'classify': case_classify,
+        'count_matrix': case_count_matrix,
+        'rank_matrix': case_rank_matrix,
+        'report_files': case_report_files,
+        'report_store': case_report_store,
+        'report_cells': case_report_cells,
+        'merge_fastq': case_merge_fastq,
+        'pipeline': case_pipeline,
+        }
+
+
+def current_rss():
+    with open('/proc/self/statm') as fh:
+        return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+
+
+def reset_peak():
+    # linux lets a process reset its own rss high-water mark, so the setup peak is not counted
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    with open('/proc/self/status') as fh:
+        for line in fh:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(name, synth, process, conn):
+    # runs in a child of its own, so peak rss belongs to this case alone
+    run = CASES[name](synth, process)
+    reset_peak()
+    base = current_rss()
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    records = run()
+    wall = time.time() - start
+    peak = peak_rss()
+    own2 = resource.getrusage(resource.RUSAGE_SELF)
+    children2 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    conn.send({
+            'wall': round(wall, 3),
+            'cpu': round(own2.ru_utime + own2.ru_stime - own.ru_utime - own.ru_stime, 3),
+            'children_cpu': round(children2.ru_utime + children2.ru_stime - children.ru_utime - children.ru_stime, 3),
+            'peak_rss_mb': round(peak, 1),
+            'rss_growth_mb': round(max(peak - base, 0), 1),
+            'children_peak_rss_mb': round(children2.ru_maxrss / 1024, 1),
+            'records': records,
+            'records_per_sec': round(records / wall, 1) if wall and records else None,
+            })
+
+
+def run_case(name, synth, process):
+    ctx = multiprocessing.get_context('fork')
+    recv, send = ctx.Pipe(False)
+    p = ctx.Process(target=measure, args=(name, synth, process, send))
+    p.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = None
+    p.join()
+    if result is None:
+        return {'error': f'exited with code {p.exitcode}'}
+    return result
+
+
+def git_commit():
+    try:
+        out = sp.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(fresults, last=2):
+    if not os.path.exists(fresults):
+        print(f'no results in {fresults}')
+        return
+    with open(fresults) as fh:
+        runs = [json.loads(line) for line in fh if line.strip()][-last:]
+    print('case'.ljust(16) + ''.join(f"{run['commit'] or '-'} {run['time'][5:16]}".rjust(30) for run in runs))
+    names = [name for run in runs for name in run['cases']]
+    for name in dict.fromkeys(names):
+        cells = []
+        for run in runs:
+            res = run['cases'].get(name, {})
+            if 'wall' not in res:
+                cells.append(res.get('error', '-').rjust(30))
+                continue
+            cells.append(f"{res['wall']:.2f}s {res['peak_rss_mb']:.0f}MB".rjust(30))
+        print(name.ljust(16) + ''.join(cells))
+
+
+def main():
+    AP = argparse.ArgumentParser(
+            description="benchmarks of the pipeline hot paths on synthetic data.",
+            formatter_class=argparse.RawTextHelpFormatter,
+            )
+    AP.add_argument('--scale', default='small', choices=sorted(SCALES), help='data size, default small')
+    AP.add_argument('--cells', type=int, help='override the number of cells of the scale')
+    AP.add_argument('--taxa', type=int, help='override the number of taxa of the scale')
+    AP.add_argument('--reads', type=int, help='override the number of kraken reads of the scale')
+    AP.add_argument('--fq-reads', type=int, help='override the number of read pairs in the fastq files')
+    AP.add_argument('--cases', default=','.join(CASES), help='comma separated cases to run, default all')
+    AP.add_argument('--process', type=int, default=4, help='worker processes, default 4')
+    AP.add_argument('--workdir', default=os.path.join(BENCH_DIR, 'data'), help='where synthetic data is generated')
+    AP.add_argument('--braken-mode', default='external', choices=['external', 'native'],
+            help='bracken of the classify and pipeline cases, default external (the stub)')
+    AP.add_argument('--compare', action='store_true', help='print the last two stored runs of the scale and exit')
+
+    args = AP.parse_args()
+    global BRAKEN_MODE
+    BRAKEN_MODE = args.braken_mode
+
+    params = dict(SCALES[args.scale])
+    for key in ('cells', 'taxa', 'reads', 'fq_reads'):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    # runs with overridden sizes are stored apart from the plain scale
+    label = args.scale if params == SCALES[args.scale] else 'custom'
+    fresults = os.path.join(BENCH_DIR, 'results', f'{label}.jsonl')
+    if args.compare:
+        compare(fresults)
+        return
+
+    root = os.path.join(args.workdir, label)
+    t = time.time()
+    synth = Synth(root, **params).build()
+    print(f'data: {root} ({time.time() - t:.1f}s)', file=sys.stderr)
+
+    record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'host': socket.gethostname(),
+            'cpus': os.cpu_count(),
+            'process': args.process,
+            'braken_mode': BRAKEN_MODE,
+            'scale': label,
+            'params': synth.params(),
+            'cases': {},
+            }
+    for name in args.cases.split(','):
+        if name not in CASES:
+            print(f'unknown case {name}, one of {",".join(CASES)}', file=sys.stderr)
+            sys.exit(1)
+        result = run_case(name, synth, args.process)
+        record['cases'][name] = result
+        print(f'{name}\t' + '\t'.join(f'{key}={val}' for key, val in result.items()))
+
+    os.makedirs(os.path.dirname(fresults), exist_ok=True)
+    with open(fresults, 'a') as fh:
+        fh.write(json.dumps(record) + '\n')
@@ -0,0 +1,224 @@
+import os
+import json
+
+import numpy as np
+
+from libs.store import RecordWriter
+from libs.utils import dir_check
+
+
+RANKS = ['D', 'P', 'C', 'O', 'F', 'G', 'S', 'S1']
+RANK_NAMES = ['domain', 'phylum', 'class', 'order', 'family', 'genus', 'species', 'strain']
+# depth of each new node below root, weighted towards genus and species like a real report
+DEPTH_WEIGHTS = [0.01, 0.03, 0.05, 0.08, 0.12, 0.25, 0.38, 0.08]
+HEADER = 'name\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n'
+
+
+class Synth:
+    # a synthetic sample laid out like a pipeline project: clean_data/, Result/ and a kraken db directory
+    def __init__(self, root, cells=200, taxa=500, reads=50000, fq_reads=None, sample='S', seed=1):
+        self.root = root
+        self.cells = cells
+        self.taxa = max(taxa, 10)
+        self.reads = reads
+        self.fq_reads = reads if fq_reads is None else fq_reads
+        self.sample = sample
+        self.rng = np.random.default_rng(seed)
+
+        self.data_dir = os.path.join(root, 'clean_data')
+        self.res_dir = os.path.join(root, 'Result')
+        self.kdb = os.path.join(root, 'kdb')
+        self.kreport = os.path.join(self.res_dir, f'{sample}_kraken.report')
+        self.koutput = os.path.join(self.res_dir, f'{sample}_kraken.output')
+        self.fq1 = os.path.join(self.data_dir, f'{sample}_1.fq')
+        self.fq2 = os.path.join(self.data_dir, f'{sample}_2.fq')
+        self.fdone = os.path.join(root, 'synth.json')
+
+    def params(self):
+        return {'cells': self.cells, 'taxa': self.taxa, 'reads': self.reads, 'fq_reads': self.fq_reads}
+
+    def valid(self):
+        if not os.path.exists(self.fdone):
+            return False
+        with open(self.fdone) as fh:
+            return json.load(fh) == self.params()
+
+    def build(self):
+        if self.valid():
+            return self
+        for path in (self.data_dir, self.res_dir, self.kdb):
+            dir_check(path)
+        self.make_taxonomy()
+        self.make_barcodes()
+        self.make_reads()
+        self.write_kreport()
+        self.write_koutput()
+        self.write_distrib()
+        self.write_braken()
+        self.write_counts()
+        self.write_fastq()
+        with open(self.fdone, 'w') as fh:
+            json.dump(self.params(), fh)
+        return self
+
+    def make_taxonomy(self):
+        # nodes in depth first order, each below the node on the stack one level up
+        rng = self.rng
+        depths = [0, 0]
+        parent = [-1, -1]
+        stack = [1]
+        draws = rng.choice(len(RANKS), size=self.taxa, p=DEPTH_WEIGHTS) + 1
+        for depth in draws.tolist():
+            if len(depths) >= self.taxa:
+                break
+            depth = min(depth, len(stack))
+            del stack[depth:]
+            parent.append(stack[-1])
+            depths.append(depth)
+            stack.append(len(depths) - 1)
+        self.depth = np.array(depths, dtype=np.int64)
+        self.parent = np.array(parent, dtype=np.int64)
+        self.tax_ids = np.r_[0, 1, np.cumsum(rng.integers(1, 20, size=len(depths) - 2)) + 1]
+        self.ranks = ['U', 'R'] + [RANKS[d - 1] for d in depths[2:]]
+        self.names = ['unclassified', 'root'] + [f'{RANK_NAMES[d - 1]} {t}' for d, t in zip(depths[2:], self.tax_ids[2:].tolist())]
+        self.species = np.flatnonzero(np.isin(self.ranks, ['S', 'S1']))
+        self.genera = np.flatnonzero(np.array(self.ranks) == 'G')
+
+    def make_barcodes(self):
+        codes = self.rng.integers(0, 4, size=(self.cells, 20), dtype=np.uint8)
+        self.barcodes = [''.join('ACGT'[c] for c in row) for row in codes.tolist()]
+        # lognormal cell sizes, a few large cells and a long tail as in a real library
+        sizes = self.rng.lognormal(0, 1.2, size=self.cells)
+        self.cell_weights = sizes / sizes.sum()
+
+    def make_reads(self):
+        # each cell draws most reads from a handful of its own taxa, the rest from anywhere or unclassified
+        rng = self.rng
+        n = self.reads
+        self.read_cell = rng.choice(self.cells, size=n, p=self.cell_weights)
+        pool = self.species if self.species.size else np.arange(2, len(self.ranks))
+        own = rng.choice(pool, size=(self.cells, 5))
+        taxon = own[self.read_cell, rng.integers(0, 5, size=n)]
+        noise = rng.random(n)
+        taxon[noise < 0.15] = rng.integers(1, len(self.ranks), size=int((noise < 0.15).sum()))
+        taxon[noise < 0.05] = 0
+        self.read_taxon = taxon
+
+    def clade_counts(self, direct):
+        clade = direct.astype(np.int64).copy()
+        for i in range(len(clade) - 1, 1, -1):
+            clade[self.parent[i]] += clade[i]
+        return clade
+
+    def write_kreport(self):
+        direct = np.bincount(self.read_taxon, minlength=len(self.ranks))
+        clade = self.clade_counts(direct)
+        clade[0] = direct[0]
+        total = max(self.reads, 1)
+        with open(self.kreport, 'w') as fh:
+            for i in range(len(self.ranks)):
+                name = '  ' * int(self.depth[i]) + self.names[i]
+                fh.write(f'{clade[i] * 100 / total:6.2f}\t{clade[i]}\t{direct[i]}\t{self.ranks[i]}\t{self.tax_ids[i]}\t{name}\n')
+        # the kraken2 stub copies this report as its own
+        with open(os.path.join(self.kdb, 'bench.kreport'), 'w') as fh, open(self.kreport) as fin:
+            fh.write(fin.read())
+
+    def write_koutput(self, chunk=1000000):
+        tax_ids = self.tax_ids.astype(str)
+        barcodes = np.array(self.barcodes)
+        lens = self.rng.integers(80, 151, size=self.reads)
+        with open(self.koutput, 'w') as fh:
+            for start in range(0, self.reads, chunk):
+                end = min(start + chunk, self.reads)
+                taxa = tax_ids[self.read_taxon[start:end]].tolist()
+                cells = barcodes[self.read_cell[start:end]].tolist()
+                fh.write(''.join(
+                    f"{'U' if t == '0' else 'C'}\tread{r}_{bc}\t{t}\t{n}\t0:1 {t}:{n - 35}\n"
+                    for r, bc, t, n in zip(range(start, end), cells, taxa, lens[start:end].tolist())))
+
+    def write_distrib(self, read_len=100):
+        # every taxon maps kmers of itself and of a few random genomes
+        rng = self.rng
+        genomes = self.species if self.species.size else np.arange(2, len(self.ranks))
+        fname = os.path.join(self.kdb, f'database{read_len}mers.kmer_distrib')
+        with open(fname, 'w') as fh:
+            fh.write('mapped_taxid\tgenome_taxids:kmers_mapped:total_genome_kmers\n')
+            for i in range(1, len(self.ranks)):
+                picks = np.unique(np.r_[rng.choice(genomes, size=3), [i] if i in genomes else []]).astype(np.int64)
+                total = rng.integers(100, 1000, size=picks.size)
+                mapped = (total * rng.random(picks.size)).astype(np.int64) + 1
+                fh.write(f'{self.tax_ids[i]}\t' + ' '.join(
+                    f'{self.tax_ids[g]}:{m}:{t}' for g, m, t in zip(picks.tolist(), mapped.tolist(), total.tolist())) + '\n')
+
+    def cell_tables(self, level):
+        # Bracken-format abundance table of every cell at `level`, from the reads assigned at or below it
+        ranks = np.array(self.ranks)
+        owner = np.full(len(ranks), -1, dtype=np.int64)
+        for i in range(2, len(ranks)):
+            if ranks[i] == level:
+                owner[i] = i
+            elif owner[self.parent[i]] >= 0:
+                owner[i] = owner[self.parent[i]]
+        node = owner[self.read_taxon]
+        keep = node >= 0
+        keys, counts = np.unique(self.read_cell[keep] * len(ranks) + node[keep], return_counts=True)
+        cells, nodes = keys // len(ranks), keys % len(ranks)
+        added = (counts * self.rng.random(counts.size) * 0.2).astype(np.int64)
+        new_reads = counts + added
+        bounds = np.flatnonzero(np.diff(cells)) + 1
+        for start, end in zip(np.r_[0, bounds].tolist(), np.r_[bounds, cells.size].tolist()):
+            total = new_reads[start:end].sum()
+            order = start + np.argsort(-new_reads[start:end], kind='stable')
+            rows = [f'{self.names[n]}\t{self.tax_ids[n]}\t{level}\t{c}\t{a}\t{r}\t{r / total:0.5f}\n'
+                    for n, c, a, r in zip(nodes[order].tolist(), counts[order].tolist(), added[order].tolist(), new_reads[order].tolist())]
+            yield self.barcodes[int(cells[start])], HEADER + ''.join(rows)
+
+    def write_braken(self):
+        # both layouts the report reads: one file per cell, and the record store
+        outputs = (('S', 'braken_report', 'braken'), ('G', 'braken_report_g', 'G.braken'))
+        for level, dir_name, suffix in outputs:
+            outdir = os.path.join(self.res_dir, dir_name)
+            dir_check(outdir)
+            writer = RecordWriter(os.path.join(self.res_dir, 'braken_store', level))
+            for cb, text in self.cell_tables(level):
+                with open(os.path.join(outdir, f'{cb}.{suffix}'), 'w') as fh:
+                    fh.write(text)
+                writer.append(cb, text)
+            writer.close()
+
+    def write_counts(self):
+        # read and UMI counts per barcode as preflight writes them, most reads first
+        counts = np.bincount(self.read_cell, minlength=self.cells)
+        order = np.argsort(-counts, kind='stable')
+        for name, scale in (('read_counts', 1.0), ('UMI_counts', 0.6)):
+            with open(os.path.join(self.data_dir, f'{self.sample}_{name}.tsv'), 'w') as fh:
+                fh.writelines(f'{self.barcodes[i]}\t{max(int(counts[i] * scale), 1)}\n' for i in order.tolist())
+
+    def write_fastq(self, chunk=200000, dup_rate=0.1):
+        # R1 is barcode + UMI, R2 a 100 bp insert; a share of the pairs repeats an earlier one exactly
+        rng = self.rng
+        n = self.fq_reads
+        barcodes = np.array(self.barcodes)
+        quals = 'F' * 100
+        with open(self.fq1, 'w') as fh1, open(self.fq2, 'w') as fh2:
+            for start in range(0, n, chunk):
+                end = min(start + chunk, n)
+                size = end - start
+                cells = barcodes[rng.choice(self.cells, size=size, p=self.cell_weights)]
+                umis = rng.integers(0, 4, size=(size, 8), dtype=np.uint8)
+                inserts = rng.integers(0, 4, size=(size, 100), dtype=np.uint8)
+                dup = np.flatnonzero(rng.random(size) < dup_rate)
+                src = rng.integers(0, np.maximum(dup, 1))
+                umis[dup] = umis[src]
+                inserts[dup] = inserts[src]
+                cells[dup] = cells[src]
+                acgt = np.frombuffer(b'ACGT', dtype=np.uint8)
+                umis = acgt[umis].view('S8').ravel()
+                inserts = acgt[inserts].view('S100').ravel()
+                lines1 = []
+                lines2 = []
+                for r, cb, umi, insert in zip(range(start, end), cells.tolist(), umis.tolist(), inserts.tolist()):
+                    lines1.append(f'@read{r}\n{cb}{umi.decode()}\n+\n{quals[:28]}\n')
+                    lines2.append(f'@read{r}\n{insert.decode()}\n+\n{quals}\n')
+                fh1.write(''.join(lines1))
+                fh2.write(''.join(lines2))
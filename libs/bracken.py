@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+
+
+HEADER = 'name\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n'
+
+
+class Bracken:
+    def __init__(self, taxan, kdb, read_len=100, threshold=10):
+        self.taxan = taxan
+        self.threshold = threshold
+
+        fdistrib = os.path.join(kdb, f'database{read_len}mers.kmer_distrib')
+        self.load_distrib(fdistrib)
+
+    def load_distrib(self, fdistrib):
+        # only genomes and mapped taxa present in the sample report can ever be used
+        index = self.taxan.index
+        genomes = []
+        mapped = []
+        fracs = []
+        with open(fdistrib) as fh:
+            for line in fh:
+                if line.startswith('mapped_taxid'):
+                    continue
+                m_taxid, dist = line.rstrip('\n').split('\t')
+                m = index.get(m_taxid, -1)
+                if m < 0:
+                    continue
+                for genome in dist.split(' '):
+                    g_taxid, mkmers, tkmers = genome.split(':')
+                    g = index.get(g_taxid, -1)
+                    if g < 0:
+                        continue
+                    genomes.append(g)
+                    mapped.append(m)
+                    fracs.append(float(mkmers) / float(tkmers))
+
+        n = len(self.taxan.tax_ids)
+        genomes = np.array(genomes, dtype=np.int64)
+        # share of its own kmers a genome keeps, 1 when the distribution has no self entry for it
+        self.self_frac = np.ones(n, dtype=np.float64)
+        own = genomes == np.array(mapped, dtype=np.int64)
+        self.self_frac[genomes[own]] = np.array(fracs, dtype=np.float64)[own]
+        order = np.argsort(genomes, kind='stable')
+        self.g_ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(genomes, minlength=n), out=self.g_ptr[1:])
+        self.g_mapped = np.array(mapped, dtype=np.int64)[order]
+        self.g_frac = np.array(fracs, dtype=np.float64)[order]
+
+    def estimate(self, direct, clade, level):
+        n = len(self.taxan.tax_ids)
+        lvl = self.taxan.level_map(level)
+
+        clade = clade.tocoo()
+        c_cell = clade.row.astype(np.int64)
+        c_node = clade.col.astype(np.int64)
+        c_reads = clade.data.astype(np.int64)
+
+        # level taxa kept by the read threshold
+        kept = (lvl[c_node] == c_node) & (c_reads >= self.threshold)
+        k_key = c_cell[kept] * n + c_node[kept]
+        order = np.argsort(k_key, kind='stable')
+        k_key = k_key[order]
+        k_cell = c_cell[kept][order]
+        k_node = c_node[kept][order]
+        k_reads = c_reads[kept][order]
+        if not k_key.size:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, empty, empty, np.zeros(0)
+
+        direct = direct.tocoo()
+        d_cell = direct.row.astype(np.int64)
+        d_node = direct.col.astype(np.int64)
+        d_reads = direct.data.astype(np.float64)
+
+        # genomes with reads of their own in a cell, under one of its kept level taxa. As in bracken,
+        # the reads a genome truly has are estimated as its own reads over its own kmer fraction
+        g_lvl = lvl[d_node]
+        g_key = d_cell * n + g_lvl
+        pos = np.minimum(np.searchsorted(k_key, g_key), k_key.size - 1)
+        present = (g_lvl >= 0) & (k_key[pos] == g_key)
+        g_cell = d_cell[present]
+        g_node = d_node[present]
+        g_kept = pos[present]
+        g_est = d_reads[present] / self.self_frac[g_node]
+
+        # reads sitting above the level are redistributed
+        above = lvl[d_node] < 0
+        p_key = d_cell[above] * n + d_node[above]
+        p_reads = d_reads[above]
+        order = np.argsort(p_key, kind='stable')
+        p_key = p_key[order]
+        p_reads = p_reads[order]
+
+        added = np.zeros(k_key.size, dtype=np.float64)
+        if p_key.size:
+            starts = self.g_ptr[g_node]
+            lens = self.g_ptr[g_node + 1] - starts
+            e_src = np.repeat(np.arange(g_node.size), lens)
+            e_pos = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(e_src.size)
+            e_key = g_cell[e_src] * n + self.g_mapped[e_pos]
+            pair = np.minimum(np.searchsorted(p_key, e_key), p_key.size - 1)
+            hit = p_key[pair] == e_key
+
+            # a source's reads go to its genomes in proportion to kmer fraction x estimated genome reads,
+            # and each genome's share is added to the level taxon above it
+            e_pair = pair[hit]
+            e_kept = g_kept[e_src[hit]]
+            weight = self.g_frac[e_pos[hit]] * g_est[e_src[hit]]
+            total = np.bincount(e_pair, weights=weight, minlength=p_key.size).astype(np.float64)
+            ok = total[e_pair] > 0
+            share = weight[ok] / total[e_pair[ok]] * p_reads[e_pair[ok]]
+            added = np.bincount(e_kept[ok], weights=share, minlength=k_key.size).astype(np.float64)
+
+        # bracken truncates the counts it prints but takes fractions of the unrounded estimates
+        new_est = k_reads + added
+        new_reads = np.floor(new_est).astype(np.int64)
+        cell_reads = np.bincount(k_cell, weights=new_est)
+        fraction = new_est / cell_reads[k_cell]
+        return k_cell, k_node, k_reads, np.floor(added).astype(np.int64), new_reads, fraction
+
+    def reports(self, direct, clade, level):
+        names = self.taxan.names
+        tax_ids = self.taxan.tax_ids
+        cell, node, reads, added, new_reads, fraction = self.estimate(direct, clade, level)
+        if not cell.size:
+            return
+
+        order = np.lexsort((-new_reads, cell))
+        cell = cell[order]
+        bounds = np.flatnonzero(np.diff(cell)) + 1
+        rows = zip(node[order].tolist(), reads[order].tolist(), added[order].tolist(),
+                new_reads[order].tolist(), fraction[order].tolist())
+        rows = [f'{names[i]}\t{tax_ids[i]}\t{level}\t{a}\t{b}\t{c}\t{f:0.5f}\n' for i, a, b, c, f in rows]
+        for start, end in zip(np.r_[0, bounds].tolist(), np.r_[bounds, cell.size].tolist()):
+            yield int(cell[start]), HEADER + ''.join(rows[start:end])
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def barcode_ranks(counts, lower=100, smooth=0.02):
+    # knee and inflection of the log-log barcode rank curve above `lower`
+    from scipy.ndimage import uniform_filter1d
+
+    counts = np.sort(np.asarray(counts, dtype=np.int64))[::-1]
+    totals, first, runs = np.unique(-counts, return_index=True, return_counts=True)
+    totals = -totals
+    # tied totals sit at their mid rank
+    ranks = first + (runs + 1) / 2
+    keep = totals > lower
+    totals, ranks = totals[keep], ranks[keep]
+    if totals.size < 3:
+        return None
+
+    x = np.log10(ranks)
+    y = uniform_filter1d(np.log10(totals), max(3, int(totals.size * smooth)), mode='nearest')
+    d1 = np.gradient(y, x)
+    d2 = np.gradient(d1, x)
+    inflection = int(np.argmin(d1))
+    knee = int(np.argmax(d2[:inflection + 1]))
+    return {
+        'knee_rank': int(ranks[knee]),
+        'knee_reads': int(totals[knee]),
+        'inflection_rank': int(ranks[inflection]),
+        'inflection_reads': int(totals[inflection]),
+        }
+
+
+def call_cells(counts, lower=100, fdr=0.01):
+    # barcodes above the knee are cells, those between `lower` and the knee are kept
+    # when their total stands out of the empty droplets at or below `lower`
+    from scipy import stats
+
+    counts = np.asarray(counts, dtype=np.int64)
+    result = {'barcodes': int(counts.size), 'lower': lower, 'fdr': fdr}
+    ranks = barcode_ranks(counts, lower)
+    if ranks is None:
+        result.update(knee_cells=int((counts > lower).sum()), tail_cells=0)
+        result['cells'] = result['knee_cells']
+        return result
+    result.update(ranks)
+
+    knee_cells = counts >= ranks['knee_reads']
+    background = np.log10(counts[(counts > 0) & (counts <= lower)])
+    candidates = (counts > lower) & ~knee_cells
+    tail = np.zeros(counts.size, dtype=bool)
+    if background.size > 1 and candidates.any():
+        center = np.median(background)
+        scale = max(stats.median_abs_deviation(background, scale='normal'), 1e-6)
+        pvals = stats.norm.sf((np.log10(counts[candidates]) - center) / scale)
+        # Benjamini-Hochberg over the candidates tested
+        order = np.argsort(pvals)
+        qvals = pvals[order] * pvals.size / np.arange(1, pvals.size + 1)
+        qvals = np.minimum.accumulate(qvals[::-1])[::-1]
+        called = np.zeros(pvals.size, dtype=bool)
+        called[order] = qvals < fdr
+        tail[np.flatnonzero(candidates)[called]] = True
+        result.update(background_log10_median=float(center), background_log10_sd=float(scale))
+
+    result['knee_cells'] = int(knee_cells.sum())
+    result['tail_cells'] = int(tail.sum())
+    result['cells'] = int((knee_cells | tail).sum())
+    return result
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+from .fastq import read_range, record_ranges
+
+
+class CellIndex:
+    # the dedup fastq regrouped by barcode in UMI count order, so the reads of the top N cells are one prefix of the file
+    def __init__(self, fq, fumi_ctx, prefix, bc_len=20):
+        self.fq = fq
+        self.fumi_ctx = fumi_ctx
+        self.bc_len = bc_len
+        self.fgrouped = f'{prefix}.cells.fq'
+        self.findex = f'{prefix}.cells.idx'
+
+    def stamp(self):
+        # size and mtime of both inputs, the index is rebuilt when either changes
+        return '\t'.join(f'{st.st_size}:{st.st_mtime_ns}' for st in map(os.stat, (self.fq, self.fumi_ctx)))
+
+    def valid(self):
+        if not (os.path.exists(self.fgrouped) and os.path.exists(self.findex)):
+            return False
+        with open(self.findex) as fh:
+            return fh.readline().rstrip('\n') == f'#{self.stamp()}'
+
+    def barcodes(self):
+        with open(self.fumi_ctx) as fh:
+            return [line.split('\t')[0].strip() for line in fh if line.strip()]
+
+    def records(self, data, rank):
+        lines = data.split(b'\n')
+        n = 4 * (len(lines) // 4)
+        sizes = np.zeros(n // 4, dtype=np.int64)
+        for k in range(4):
+            sizes += np.fromiter(map(len, lines[k:n:4]), dtype=np.int64, count=n // 4) + 1
+        bc_len = self.bc_len
+        ranks = np.fromiter((rank.get(seq[:bc_len], -1) for seq in lines[1:n:4]), dtype=np.int64, count=n // 4)
+        return ranks, sizes
+
+    def build(self, chunk=100000):
+        stamp = self.stamp()
+        barcodes = self.barcodes()
+        rank = {bc.encode(): i for i, bc in enumerate(barcodes)}
+
+        # first pass sizes every cell, the second writes each record at its cell's cursor
+        totals = np.zeros(len(barcodes), dtype=np.int64)
+        for start, end in record_ranges(self.fq, chunk):
+            ranks, sizes = self.records(read_range(self.fq, start, end), rank)
+            keep = ranks >= 0
+            totals += np.bincount(ranks[keep], weights=sizes[keep], minlength=totals.size).astype(np.int64)
+        offsets = np.cumsum(totals) - totals
+
+        cursor = offsets.copy()
+        fd = os.open(self.fgrouped, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            for start, end in record_ranges(self.fq, chunk):
+                data = read_range(self.fq, start, end)
+                ranks, sizes = self.records(data, rank)
+                starts = np.cumsum(sizes) - sizes
+                order = np.argsort(ranks, kind='stable')
+                order = order[ranks[order] >= 0]
+                if not order.size:
+                    continue
+                view = memoryview(data)
+                bounds = np.flatnonzero(np.diff(ranks[order])) + 1
+                for group in np.split(order, bounds):
+                    r = ranks[group[0]]
+                    block = b''.join([view[s:s + z] for s, z in zip(starts[group].tolist(), sizes[group].tolist())])
+                    os.pwrite(fd, block, int(cursor[r]))
+                    cursor[r] += len(block)
+        finally:
+            os.close(fd)
+
+        with open(self.findex, 'w') as fh:
+            fh.write(f'#{stamp}\n')
+            for bc, offset, length in zip(barcodes, offsets.tolist(), totals.tolist()):
+                fh.write(f'{bc}\t{offset}\t{length}\n')
+
+    def extract(self, cell_num, fout, block=64 << 20):
+        # reads of the first cell_num barcodes, formatted as readsRetriev2 writes them
+        if not self.valid():
+            self.build()
+        with open(self.findex) as fh:
+            fh.readline()
+            lengths = [int(line.split('\t')[2]) for _, line in zip(range(cell_num), fh)]
+
+        bc_len = self.bc_len
+        with open(self.fgrouped, 'rb') as fin, open(fout, 'wb') as fh:
+            pending = 0
+            for i, length in enumerate(lengths):
+                pending += length
+                if pending < block and i < len(lengths) - 1:
+                    continue
+                lines = fin.read(pending).split(b'\n')
+                pending = 0
+                n = 4 * (len(lines) // 4)
+                records = zip(lines[0:n:4], lines[1:n:4], lines[3:n:4])
+                fh.write(b''.join([b'%s_%s\n%s\n+\n%s\n' % (head, seq[:bc_len], seq[28:], qual[28:]) for head, seq, qual in records]))
@@ -1,17 +1,36 @@
 import os
 import sys
-import copy
+import queue
+import time
+import shutil
+import logging
+import cProfile
 
 import multiprocessing
 import subprocess as sp
 from collections import defaultdict
 from multiprocessing import Pool, Process, Queue
 
-from .utils import read_config, readme_parser, dir_check
+import numpy as np
+from scipy import sparse
 
+from .bracken import Bracken
+from .koutput import load_kraken_output
+from .runprofile import run_profile
+from .shared import SharedArrays
+from .store import RecordWriter
+from .utils import read_config, readme_parser, dir_check, is_on
 
-def run_kraken(fq_valid, config):
+
+def kraken_paths(config):
     sample = config['sample']
+    res_dir = os.path.join(config['outdir'], 'Result')
+    report = os.path.join(res_dir, f'{sample}_kraken.report')
+    output = os.path.join(res_dir, f'{sample}_kraken.output')
+    return report, output
+
+
+def run_kraken(fq_valid, config):
     proj_dir = config['outdir']
     res_dir = os.path.join(proj_dir, 'Result')
     kraken2 = config['kraken']
@@ -20,19 +39,19 @@ def run_kraken(fq_valid, config):
     fq_classify = os.path.join(res_dir, 'output_classified.fq')
     fq_unclassify = os.path.join(res_dir, 'output_unclassified.fq')
 
-    output = os.path.join(res_dir, f'{sample}_kraken.output')
-    report = os.path.join(res_dir, f'{sample}_kraken.report')
+    report, output = kraken_paths(config)
 
-    sp.run([
-        kraken2,
-        '--threads', config.get('process', '4'),
-        '--db', kdb,
-        '--unclassified-out', fq_unclassify,
-        '--classified-out', fq_classify,
-        '--report', report,
-        '--output', output,
-        fq_valid
-    ])
+    with run_profile.stage('kraken', [fq_valid], [report, output, fq_classify, fq_unclassify]):
+        sp.run([
+            kraken2,
+            '--threads', config.get('process', '4'),
+            '--db', kdb,
+            '--unclassified-out', fq_unclassify,
+            '--classified-out', fq_classify,
+            '--report', report,
+            '--output', output,
+            fq_valid
+        ])
     return report, output
 
 
@@ -52,150 +71,357 @@ class Classifier:
         dir_check(self.braken_dir_g)
         self.braken = self.config['braken']
         self.kdb = self.config['krakenDb']
-        self.keys = ['ratio', 'sum', 'counts', 'class', 'tax_id', 'name']
+        self.batch = is_on(self.config.get('batch_rollup'))
+        # the built-in engine works on the batch rollup matrices
+        self.native = self.config.get('braken_mode', '') == 'native'
+        if self.native:
+            self.batch = True
+        self.chunk = 500
+        self.arrays = None
+        # per-cell abundance tables go to one record store per level instead of one file per cell
+        self.store = is_on(self.config.get('braken_store'))
+        self.store_dir = os.path.join(self.res_dir, 'braken_store')
+        self.writers = {}
+        # barcodes whose tables are saved, a resumed run skips them
+        self.fdone = os.path.join(self.res_dir, f'{self.sample}_classify.done')
+        self.done_log = None
+        # seconds a worker spends in bracken, native or external
+        self.bracken_time = 0.0
+        # keep the parsed kraken output as a binary cache next to it, on unless turned off
+        self.koutput_cache = is_on(self.config.get('koutput_cache', 'on'))
 
         self.taxan = Taxanomy(kreport)
     
-    def cell_report(self, koutput):
-        self.tmp_dir = tmp_dir
-        dir_check(tmp_dir)
-
-        data = defaultdict(lambda : defaultdict(int))
-        with open(koutput) as fh:
-            for line in fh:
-                arr = line.split()
-                _, cb = arr[1].split('_')
-                data[cb][arr[2]] += 1
-
-        for cb, counts in data.items():
-            cb_report = os.path.join(tmp_dir, f'{cb}.kreport')
-            result, total = self.cell_taxan(counts)
-            with open(cb_report, 'w') as fh:
-                for item in result:
-                    arr = [str(item[k]) for k in keys]
-                    fh.write('\t'.join(arr) + '\n')
-            self.run_braken(cb_report, cb)
-
-    def producer(self, bc_counts, bc_queue):
-        for bc in bc_counts:
-            bc_queue.put(bc)
-        return None
-
-    def consumer(self, bc_counts, bc_queue):
-        #curr_proc = multiprocessing.current_process()
+    def consumer(self, shm_name, spec, task_queue, result_queue):
+        shared = SharedArrays.attach(shm_name, spec)
+        self.arrays = shared.arrays
+        profiler = None
+        if run_profile.prof_dir is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        stats = {'stage': 'classify_worker', 'pid': os.getpid(), 'blocks': 0, 'cells': 0, 'busy': 0.0}
+        started = time.time()
+        cpu = time.process_time()
         while True:
-            cb = bc_queue.get()
-            if cb is None:
-                break
-
-            counts = bc_counts[cb]
-            cb_report = os.path.join(self.tmp_dir, f'{cb}.kreport')
-            result, total = self.cell_taxan(counts)
-            with open(cb_report, 'w') as fh:
-                for item in result:
-                    arr = [str(item[k]) for k in self.keys]
-                    fh.write('\t'.join(arr) + '\n')
-            self.run_braken(cb_report, cb)
-
-    def worker_pool(self, koutput):
-        bc_queue = Queue(maxsize = 50000)
-
-        bc_counts = defaultdict(lambda : defaultdict(int))
-        with open(koutput) as fh:
-            for line in fh:
-                arr = line.split()
-                _, cb = arr[1].split('_')
-                bc_counts[cb][arr[2]] += 1
-
-        p1 = Process(target=self.producer, args=(bc_counts, bc_queue, ))
-        p1.start()
-
-        jobs = []
-        for i in range(self.p):
-            p = Process(target=self.consumer, args=(bc_counts, bc_queue, ))
-            p.start()
-            jobs.append(p)
-
-        p1.join()
-        for i in range(self.p):
-            bc_queue.put(None)
-        for p in jobs:
-            p.join()
-
-        return None
-
-    def tax_scan(self, taxon_tree, tax_id, counts):
-        idx = 0
-        tax_cts = 0
-        for i, item in enumerate(taxon_tree):
-            if item['tax_id'] == tax_id:
-                idx = i
-                item['hit'] = 1
-                tax_cts = counts[tax_id]
-                item['counts'] = tax_cts
-                item['sum'] += tax_cts
+            task = task_queue.get()
+            if task is None:
                 break
+            start, end = task
+            t = time.time()
+            result_queue.put(self.cell_block(start, end))
+            stats['busy'] += time.time() - t
+            stats['blocks'] += 1
+            stats['cells'] += end - start
+        self.arrays = None
+        shared.close()
+        scratch = os.path.join(self.tmp_dir, f'worker{os.getpid()}.kreport')
+        if os.path.exists(scratch):
+            os.remove(scratch)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(run_profile.prof_dir, f'classify_worker{os.getpid()}.prof'))
+
+        # the last message of a worker is its throughput
+        stats['wall'] = time.time() - started
+        stats['cpu'] = time.process_time() - cpu
+        stats['bracken'] = self.bracken_time
+        stats['cells_per_sec'] = stats['cells'] / stats['busy'] if stats['busy'] else 0.0
+        result_queue.put({'worker': {key: round(val, 3) if isinstance(val, float) else val for key, val in stats.items()}})
+
+    def cell_block(self, start, end):
+        result = {'start': start, 'end': end, 'kreport': [], 'S': [], 'G': [], 'log': []}
+        for i in range(start, end):
+            if self.batch:
+                lines, total = self.batch_taxan(i)
+            else:
+                lines, total = self.count_taxan(i)
+            if self.native:
+                result['kreport'].append((i, ''.join(lines)))
+                continue
 
-        def recur_search(taxon_tree, i, tax_cts):
-            item = taxon_tree[i]
+            cb = self.barcodes[i]
+            if not self.store:
+                cb_report = os.path.join(self.tmp_dir, f'{cb}.kreport')
+                with open(cb_report, 'w') as fh:
+                    fh.writelines(lines)
+                t = time.time()
+                self.run_braken(cb_report, cb)
+                self.bracken_time += time.time() - t
+                continue
 
-            if item['indent'] == 0:
-                item['hit'] = 1
-                return 
+            # bracken reads and writes scratch files of this worker, reused cell after cell
+            scratch = os.path.join(self.tmp_dir, f'worker{os.getpid()}')
+            cb_report = f'{scratch}.kreport'
+            output = f'{scratch}.braken'
+            output_g = f'{scratch}.G.braken'
+            with open(cb_report, 'w') as fh:
+                fh.writelines(lines)
+            t = time.time()
+            result['log'].append((i, self.run_braken(cb_report, cb, output, output_g)))
+            self.bracken_time += time.time() - t
+            result['kreport'].append((i, ''.join(lines)))
+            for level, fout in (('S', output), ('G', output_g)):
+                if not os.path.exists(fout):
+                    continue
+                with open(fout) as fh:
+                    result[level].append((i, fh.read()))
+                os.remove(fout)
+
+        if self.native:
+            t = time.time()
+            direct = self.block_rows('direct', start, end)
+            clade = self.block_rows('clade', start, end)
+            for level in ('S', 'G'):
+                result[level] = [(start + i, text) for i, text in self.engine.reports(direct, clade, level)]
+            self.bracken_time += time.time() - t
+        return result
 
-            j = item['father']
-            if j:
-                taxon_tree[j]['hit'] = 1
-                taxon_tree[j]['sum'] += tax_cts
+    def save_block(self, result):
+        outputs = [
+                ('kreport', self.tmp_dir, 'kreport'),
+                ('S', self.braken_dir, 'braken'),
+                ('G', self.braken_dir_g, 'G.braken'),
+                ('log', self.tmp_dir, 'braken.log'),
+                ]
+        for key, outdir, suffix in outputs:
+            if key in self.writers:
+                writer = self.writers[key]
+                for i, text in result[key]:
+                    writer.append(self.barcodes[i], text)
+                writer.flush()
+                continue
+            for i, text in result[key]:
+                cb = self.barcodes[i]
+                with open(os.path.join(outdir, f'{cb}.{suffix}'), 'w') as fh:
+                    fh.write(text)
+        if self.done_log is not None:
+            self.done_log.writelines(f'{self.barcodes[i]}\n' for i in range(result['start'], result['end']))
+            self.done_log.flush()
+
+    def finished(self):
+        if not os.path.exists(self.fdone):
+            return set()
+        with open(self.fdone) as fh:
+            return set(line.rstrip('\n') for line in fh)
+
+    def reset(self):
+        # a fresh run drops the records of an earlier one
+        if self.store and os.path.exists(self.store_dir):
+            shutil.rmtree(self.store_dir)
+        open(self.fdone, 'w').close()
+
+    def worker_pool(self, koutput, resume=False):
+        with run_profile.stage('classify', [koutput]) as entry:
+            bc_counts = load_kraken_output(koutput, self.p, self.koutput_cache)
+            if resume:
+                done = self.finished()
+                rows = [i for i, cb in enumerate(bc_counts.barcodes) if cb not in done]
+                logging.info(f'classify: resuming, {len(bc_counts) - len(rows)} of {len(bc_counts)} barcodes already done.')
+                bc_counts = bc_counts.rows(rows)
+                if not rows:
+                    return None
+            else:
+                self.reset()
+            entry['records'] = len(bc_counts)
+            entry['reads'] = int(bc_counts.matrix.sum())
+            self.barcodes = bc_counts.barcodes
+            if self.batch:
+                arrays = self.batch_rollup(bc_counts)
             else:
-                indent = item['indent']
-
-                j = i - 1
-                while j >= 0:
-                    item_prev = taxon_tree[j]
-                    if item_prev['indent'] < indent:
-                        taxon_tree[i]['father'] = j
-                        taxon_tree[j]['hit'] = 1
-                        taxon_tree[j]['sum'] += tax_cts
-                        break
-                    j -= 1
-            return recur_search(taxon_tree, j, tax_cts)
-        recur_search(taxon_tree, idx, tax_cts)
+                arrays = self.count_arrays(bc_counts)
+            del bc_counts
+            if self.native:
+                self.engine = Bracken(self.taxan, self.kdb)
+
+            # workers read the per-cell arrays from shared memory and take cells in blocks
+            shared = SharedArrays.create(arrays)
+            self.arrays = None
+            del arrays
+
+            # whatever goes wrong below, the workers are stopped and the segment leaves /dev/shm
+            jobs = []
+            try:
+                n = len(self.barcodes)
+                chunk = max(1, min(self.chunk, -(-n // (self.p * 4))))
+                task_queue = Queue()
+                result_queue = Queue()
+                for start in range(0, n, chunk):
+                    task_queue.put((start, min(start + chunk, n)))
+                for i in range(self.p):
+                    task_queue.put(None)
+
+                for i in range(self.p):
+                    p = Process(target=self.consumer, args=(shared.name, shared.spec, task_queue, result_queue, ))
+                    p.start()
+                    jobs.append(p)
+
+                if self.store:
+                    for level in ('S', 'G', 'kreport', 'log'):
+                        self.writers[level] = RecordWriter(os.path.join(self.store_dir, level))
+                self.done_log = open(self.fdone, 'a')
+
+                running = self.p
+                while running:
+                    try:
+                        result = result_queue.get(timeout=5)
+                    except queue.Empty:
+                        if any(p.exitcode for p in jobs):
+                            raise RuntimeError('classifier worker exited abnormally')
+                        continue
+                    if 'worker' in result:
+                        running -= 1
+                        run_profile.add(result['worker'])
+                        continue
+                    self.save_block(result)
+
+                for p in jobs:
+                    p.join()
+            finally:
+                for p in jobs:
+                    if p.is_alive():
+                        p.terminate()
+                        p.join()
+                shared.unlink()
+                for writer in self.writers.values():
+                    writer.close()
+                self.writers = {}
+                if self.done_log is not None:
+                    self.done_log.close()
+                    self.done_log = None
 
         return None
 
     def cell_taxan(self, counts):
-        taxon_tree = copy.deepcopy(self.taxan.data)
-
-        total = 0
-        for tax_id in counts:
-            total += counts[tax_id]
-            self.tax_scan(taxon_tree, tax_id, counts)
+        index = self.taxan.index
+        idx = np.fromiter((index.get(tax_id, -1) for tax_id in counts), dtype=np.int64, count=len(counts))
+        cts = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        return self.rollup_taxan(idx, cts)
+
+    def count_taxan(self, i):
+        a = self.arrays
+        start, end = a['counts_indptr'][i], a['counts_indptr'][i + 1]
+        idx = a['col_nodes'][a['counts_indices'][start:end]]
+        return self.rollup_taxan(idx, a['counts_data'][start:end])
+
+    def rollup_taxan(self, idx, cts):
+        total = int(cts.sum())
+
+        # reads of tax_ids missing from the report stay in the total and flag the first line
+        known = idx >= 0
+        nodes, sums, direct = self.taxan.rollup(idx[known], cts[known])
+        if not known.all() and (not len(nodes) or nodes[0] != 0):
+            nodes = np.insert(nodes, 0, 0)
+            sums = np.insert(sums, 0, 0)
+            direct = np.insert(direct, 0, 0)
+
+        return self.format_kreport(nodes, sums, direct, total), total
+
+    def col_nodes(self, bc_counts):
+        index = self.taxan.index
+        return np.array([index.get(tax_id, -1) for tax_id in bc_counts.tax_ids], dtype=np.int64)
+
+    def count_arrays(self, bc_counts):
+        matrix = bc_counts.matrix
+        self.arrays = {
+                'counts_indptr': matrix.indptr,
+                'counts_indices': matrix.indices,
+                'counts_data': matrix.data.astype(np.int64),
+                'col_nodes': self.col_nodes(bc_counts),
+                }
+        return self.arrays
+
+    def batch_rollup(self, bc_counts):
+        counts = bc_counts.matrix.tocoo()
+        nodes = self.col_nodes(bc_counts)[counts.col]
+        known = nodes >= 0
+
+        totals = np.asarray(bc_counts.matrix.sum(axis=1), dtype=np.int64).ravel()
+        unknown = np.bincount(counts.row[~known], minlength=len(bc_counts)) > 0
+
+        n = len(self.taxan.tax_ids)
+        direct = sparse.csr_matrix(
+                (counts.data[known].astype(np.int64), (counts.row[known], nodes[known])),
+                shape=(len(bc_counts), n))
+        direct.sum_duplicates()
+
+        # cell x node clade sums in one product with the node -> ancestor matrix
+        clade = (direct @ self.taxan.ancestor_matrix()).tocsr()
+        clade.sort_indices()
+        self.arrays = {
+                'direct_indptr': direct.indptr,
+                'direct_indices': direct.indices,
+                'direct_data': direct.data,
+                'clade_indptr': clade.indptr,
+                'clade_indices': clade.indices,
+                'clade_data': clade.data,
+                'ratios': clade.data * 100 / np.repeat(totals, np.diff(clade.indptr)),
+                'totals': totals,
+                'unknown': unknown,
+                }
+        return self.arrays
+
+    def block_rows(self, name, start, end):
+        a = self.arrays
+        indptr = a[f'{name}_indptr'][start:end + 1]
+        lo, hi = indptr[0], indptr[-1]
+        return sparse.csr_matrix(
+                (a[f'{name}_data'][lo:hi], a[f'{name}_indices'][lo:hi], indptr - lo),
+                shape=(end - start, len(self.taxan.tax_ids)))
+
+    def batch_taxan(self, i):
+        a = self.arrays
+        start, end = a['clade_indptr'][i], a['clade_indptr'][i + 1]
+        nodes = a['clade_indices'][start:end]
+        sums = a['clade_data'][start:end]
+        ratios = a['ratios'][start:end]
+        total = int(a['totals'][i])
+
+        d_start, d_end = a['direct_indptr'][i], a['direct_indptr'][i + 1]
+        direct = np.zeros(nodes.size, dtype=np.int64)
+        direct[np.searchsorted(nodes, a['direct_indices'][d_start:d_end])] = a['direct_data'][d_start:d_end]
+
+        if a['unknown'][i] and (not nodes.size or nodes[0] != 0):
+            nodes = np.insert(nodes, 0, 0)
+            sums = np.insert(sums, 0, 0)
+            direct = np.insert(direct, 0, 0)
+            ratios = np.insert(ratios, 0, 0.0)
+
+        return self.format_kreport(nodes, sums, direct, total, ratios), total
+
+    def format_kreport(self, nodes, sums, direct, total, ratios=None):
+        ranks = self.taxan.ranks
+        tax_ids = self.taxan.tax_ids
+        labels = self.taxan.labels
 
         result = []
-        for item in taxon_tree:
-            if item['hit'] == 0:
-                continue
-            ratio = item['sum'] * 100/total
-            item['ratio'] = f'{ratio:.2f}'
-            item['name'] = ' ' * item['indent'] + item['name']
-            result.append(item)
-        
-        result[0]['sum'] = result[0]['counts']
-        ratio = result[0]['counts'] * 100/total
-        result[0]['ratio'] = f'{ratio:.2f}'
-
-        return result, total
-
-    def run_braken(self, report, cb):
-        output = os.path.join(self.braken_dir, f'{cb}.braken')
-        output_g = os.path.join(self.braken_dir_g, f'{cb}.G.braken')
-        b_log = os.path.join(self.tmp_dir, f'{cb}.braken.log')
-        g_log = os.path.join(self.tmp_dir, f'{cb}.G.braken.log')
-        fh = open(b_log, 'w')
-        fhg = open(g_log, 'w')
+        sums = sums.tolist()
+        direct = direct.tolist()
+        if ratios is None:
+            ratios = [s * 100/total for s in sums]
+        else:
+            ratios = ratios.tolist()
+        # the leading line reports its own reads only
+        sums[0] = direct[0]
+        ratios[0] = direct[0] * 100/total
+        for i, ratio, s, c in zip(nodes.tolist(), ratios, sums, direct):
+            result.append(f'{ratio:.2f}\t{s}\t{c}\t{ranks[i]}\t{tax_ids[i]}\t{labels[i]}\n')
+        return result
 
-        sp.run([
+    def run_braken(self, report, cb, output=None, output_g=None):
+        if output is None:
+            output = os.path.join(self.braken_dir, f'{cb}.braken')
+        if output_g is None:
+            output_g = os.path.join(self.braken_dir_g, f'{cb}.G.braken')
+        # in store mode the logs are returned for the store instead of written per cell
+        if self.store:
+            fh = fhg = sp.PIPE
+        else:
+            b_log = os.path.join(self.tmp_dir, f'{cb}.braken.log')
+            g_log = os.path.join(self.tmp_dir, f'{cb}.G.braken.log')
+            fh = open(b_log, 'w')
+            fhg = open(g_log, 'w')
+
+        res = sp.run([
             self.braken, 
             '-d', self.kdb,
             '-i', report,
@@ -203,7 +429,7 @@ class Classifier:
             '-r', '100'
         ], stdout=fh)
 
-        sp.run([
+        res_g = sp.run([
             self.braken, 
             '-d', self.kdb,
             '-i', report,
@@ -211,11 +437,14 @@ class Classifier:
             '-r', '100',
             '-l', 'G'
         ], stdout=fhg)
+        if self.store:
+            return (res.stdout + res_g.stdout).decode(errors='replace')
 
 class Taxanomy:
     def __init__(self, kreport):
         self.data = []
         self.create_db(kreport)
+        self.compile()
 
     def create_db(self, kreport):
         with open(kreport) as fh:
@@ -224,42 +453,168 @@ class Taxanomy:
                 item = self.create_item(arr)
                 self.data.append(item)
 
-    def search(self, tax_id):
+    def compile(self):
+        n = len(self.data)
+        self.tax_ids = tuple(item['tax_id'] for item in self.data)
+        self.ranks = tuple(item['class'] for item in self.data)
+        self.names = tuple(item['name'] for item in self.data)
+        self.labels = tuple(' ' * item['indent'] + item['name'] for item in self.data)
+
+        self.index = {}
+        for i, tax_id in enumerate(self.tax_ids):
+            self.index.setdefault(tax_id, i)
+
+        # the report lists nodes depth first, so the subtree of node i is the row interval [i, end[i])
+        indent = [item['indent'] for item in self.data]
+        parent = [-1] * n
+        end = [n] * n
+        stack = []
+        for i in range(n):
+            while stack and indent[stack[-1]] >= indent[i]:
+                end[stack.pop()] = i
+            if indent[i] > 0 and stack:
+                parent[i] = stack[-1]
+            stack.append(i)
+
+        # lineage of every node (itself first, up to its top level node) as a flat CSR layout
+        lineage = [None] * n
+        for i in range(n):
+            j = parent[i]
+            lineage[i] = (i,) + lineage[j] if j >= 0 else (i,)
+        lens = np.fromiter(map(len, lineage), dtype=np.int64, count=n)
+        anc_ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lens, out=anc_ptr[1:])
+        anc_idx = np.fromiter((j for path in lineage for j in path), dtype=np.int32, count=int(anc_ptr[-1]))
+
+        self.indent = np.array(indent, dtype=np.int32)
+        self.parent = np.array(parent, dtype=np.int32)
+        self.end = np.array(end, dtype=np.int64)
+        # ancestors above each node, 0 for a top level node
+        self.depth = lens - 1
+        self.anc_ptr = anc_ptr
+        self.anc_idx = anc_idx
+        for arr in (self.indent, self.parent, self.end, self.depth, self.anc_ptr, self.anc_idx):
+            arr.flags.writeable = False
+        # row -1 (a tax_id missing from the report) maps to ''
+        self.tax_arr = np.array(self.tax_ids + ('',))
+        self._anc_mat = None
+        self._lineage = {}
+        self._levels = {}
+
+    def ancestor_matrix(self):
+        # node x node, one entry per (node, ancestor-or-self) pair
+        if self._anc_mat is None:
+            n = len(self.tax_ids)
+            data = np.ones(self.anc_idx.size, dtype=np.int64)
+            self._anc_mat = sparse.csr_matrix((data, self.anc_idx, self.anc_ptr), shape=(n, n))
+        return self._anc_mat
+
+    def level_map(self, level):
+        # nearest ancestor-or-self of every node at rank `level`, -1 above it
+        if level not in self._levels:
+            n = len(self.tax_ids)
+            is_level = np.array([rank == level for rank in self.ranks], dtype=bool)
+            pos = np.flatnonzero(is_level[self.anc_idx])
+            owner = np.repeat(np.arange(n), np.diff(self.anc_ptr))[pos]
+            owner, first = np.unique(owner, return_index=True)
+            lvl = np.full(n, -1, dtype=np.int64)
+            lvl[owner] = self.anc_idx[pos[first]]
+            lvl.flags.writeable = False
+            self._levels[level] = lvl
+        return self._levels[level]
+
+    def rollup(self, idx, cts):
+        # clade sums over every node hit by direct counts `cts` on nodes `idx`
+        starts = self.anc_ptr[idx]
+        lens = self.anc_ptr[idx + 1] - starts
+        offset = np.repeat(starts - np.cumsum(lens) + lens, lens)
+        hits = self.anc_idx[offset + np.arange(offset.size)]
+
+        nodes, inv = np.unique(hits, return_inverse=True)
+        sums = np.bincount(inv, weights=np.repeat(cts, lens), minlength=nodes.size).astype(np.int64)
+        direct = np.zeros(nodes.size, dtype=np.int64)
+        direct[np.searchsorted(nodes, idx)] = cts
+        return nodes, sums, direct
+
+    def nodes(self, tax_ids):
+        # row of every tax_id, -1 when it is not in the report
+        tax_ids = np.atleast_1d(np.asarray(tax_ids)).astype(str).ravel()
+        index = self.index
+        return np.fromiter((index.get(t, -1) for t in tax_ids.tolist()), dtype=np.int64, count=tax_ids.size)
+
+    def ancestor_at(self, idx, depth):
+        # ancestor at `depth` below the top of each node, -1 where there is none
+        idx, depth = np.broadcast_arrays(np.asarray(idx, dtype=np.int64), np.asarray(depth, dtype=np.int64))
+        safe = np.where(idx >= 0, idx, 0)
+        ok = (idx >= 0) & (depth >= 0) & (depth <= self.depth[safe])
+        pos = self.anc_ptr[safe] + np.where(ok, self.depth[safe] - depth, 0)
+        return np.where(ok, self.anc_idx[pos], -1)
+
+    def contains(self, clade, idx):
+        # whether each node idx lies in the subtree of node clade
+        clade, idx = np.broadcast_arrays(np.asarray(clade, dtype=np.int64), np.asarray(idx, dtype=np.int64))
+        safe = np.where(clade >= 0, clade, 0)
+        return (clade >= 0) & (idx >= clade) & (idx < self.end[safe])
+
+    def lca_nodes(self, a, b):
+        # pairwise lowest common ancestor, -1 for nodes under different top level nodes.
+        # a's ancestor at depth d holds b for every d up to the answer and for none below it,
+        # so a binary search over d takes log(depth) vectorized steps
+        a, b = np.broadcast_arrays(np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64))
+        ok = (a >= 0) & (b >= 0)
+        a = np.where(ok, a, 0)
+        b = np.where(ok, b, 0)
+        ok &= self.contains(self.ancestor_at(a, 0), b)
+        lo = np.zeros(a.shape, dtype=np.int64)
+        hi = np.where(ok, np.minimum(self.depth[a], self.depth[b]), 0)
+        while np.any(lo < hi):
+            mid = (lo + hi + 1) // 2
+            hit = self.contains(self.ancestor_at(a, mid), b)
+            lo = np.where(hit, mid, lo)
+            hi = np.where(hit, hi, mid - 1)
+        return np.where(ok, self.ancestor_at(a, lo), -1)
+
+    def lca(self, tax_a, tax_b):
+        # tax_ids of the pairwise lowest common ancestors, '' where there is none
+        return self.tax_arr[self.lca_nodes(self.nodes(tax_a), self.nodes(tax_b))]
+
+    def lca_all(self, tax_ids):
+        # in depth first order the common ancestor of a set is that of its first and last node
+        idx = self.nodes(tax_ids)
+        if idx.size == 0 or np.any(idx < 0):
+            return ''
+        return self.tax_arr[self.lca_nodes(idx.min(), idx.max())]
+
+    def within(self, tax_ids, clade):
+        # whether each tax_id is clade or below it, e.g. to pick the reads of a clade
+        return self.contains(self.nodes(clade)[0], self.nodes(tax_ids))
+
+    def descendants(self, tax_id):
+        # tax_ids of the subtree of tax_id, itself first
+        i = self.nodes(tax_id)[0]
+        if i < 0:
+            return self.tax_arr[:0]
+        return self.tax_arr[i:self.end[i]]
+
+    def lineage(self, tax_ids, sep=';'):
+        # names from the top down to each tax_id, root left out, '' for unknown tax_ids
         result = []
-        def recur_search(data, i, result):
-            item = data[i]
-
-            if item['indent'] == 0:
-                if result[-1]['name'] == 'root':
-                    return result[0:-1]
-                return result
-
-            j = item['father']
-            if j:
-                father = data[j]
-                result.append(father)
-            else:
-                indent = item['indent']
-
-                j = i - 1
-                while j > 1:
-                    item_prev = data[j]
-                    if item_prev['indent'] < indent:
-                        data[i]['father'] = j
-                        result.append(item_prev)
-                        break
-                    j -= 1
-            return recur_search(data, j, result)
-
-        idx = 0
-        for i, item in enumerate(self.data):
-            if item['tax_id'] == tax_id:
-                idx = i
-                break
-        result.append(self.data[idx])
-        recur_search(self.data, idx, result)
+        for i in self.nodes(tax_ids).tolist():
+            if i < 0:
+                result.append('')
+                continue
+            if i not in self._lineage:
+                path = self.anc_idx[self.anc_ptr[i]:self.anc_ptr[i + 1]].tolist()
+                self._lineage[i] = [self.names[j] for j in reversed(path) if self.ranks[j] != 'R']
+            result.append(sep.join(self._lineage[i]))
         return result
 
+    def search(self, tax_id):
+        # the item of tax_id and those of its ancestors below root, the unclassified row for an unknown tax_id
+        i = self.index.get(tax_id, 0)
+        path = self.anc_idx[self.anc_ptr[i]:self.anc_ptr[i + 1]].tolist()
+        return [self.data[i]] + [self.data[j] for j in path[1:] if self.ranks[j] != 'R']
+
     def create_item(self, arr):
         sci_name = arr[-1].strip()
         tmp = arr[-1].split(' ')
@@ -1,29 +1,142 @@
 import os
 import sys
+import logging
 import argparse
 
-from .utils import read_config
+from .utils import read_config, is_on
 from .preflight import PreFlight
-from .classify import Classifier, run_kraken
+from .classify import Classifier, run_kraken, kraken_paths
+from .manifest import Manifest
+from .scheduler import Scheduler
 from .report import Report
+from .rankmatrix import RankMatrix, parse_ranks
+from .runprofile import run_profile
 
 
 
+def run_stages(config, obj_pre):
+    sample = config['sample']
+    data_dir = os.path.join(config['outdir'], 'clean_data')
+    res_dir = os.path.join(config['outdir'], 'Result')
+    dir_name = os.path.abspath(os.path.dirname(__file__))
+
+    fq1 = os.path.join(data_dir, f'{sample}_1.fq')
+    fq2 = os.path.join(data_dir, f'{sample}_2.fq')
+    reads_ctx = os.path.join(data_dir, f'{sample}_read_counts.tsv')
+    fumi_ctx = os.path.join(data_dir, f'{sample}_UMI_counts.tsv')
+    fq_final = os.path.join(data_dir, f'{sample}_final_2.fq')
+    kreport, koutput = kraken_paths(config)
+    kdb = config.get('krakenDb')
+    if is_on(config.get('braken_store')):
+        braken_out = [os.path.join(res_dir, 'braken_store')]
+    else:
+        braken_out = [os.path.join(res_dir, 'braken_report'), os.path.join(res_dir, 'braken_report_g')]
+
+    # resume=on skips every stage whose inputs and outputs are unchanged since it last finished
+    stages = Manifest(os.path.join(res_dir, f'{sample}_stages.json'), is_on(config.get('resume')))
+
+    def preflight(resume):
+        if not obj_pre.streaming:
+            obj_pre.run()
+        else:
+            # kraken2 reads the stream, so it belongs to this stage
+            with run_profile.stage('stream', [fq1, fq2], [reads_ctx, fumi_ctx, kreport, koutput]):
+                fq_valid = obj_pre.run()
+                run_kraken(fq_valid, config)
+                obj_pre.wait()
+        obj_pre.start_plots()
+
+    def kraken(resume):
+        run_kraken(fq_final, config)
+
+    def classify(resume):
+        classifier = Classifier(config, kreport)
+        classifier.worker_pool(koutput, resume)
+
+    def report(resume):
+        reporter = Report(config)
+        reporter.report()
+
+    def rank_matrix(resume):
+        RankMatrix(config, kreport).run(koutput)
+
+    pre_keys = ['stream', 'dedup_mode', 'cell_num', 'cell_lower', 'cell_fdr']
+    pre_tools = [config.get('nubeam_dedup'), os.path.join(dir_name, 'readsRetriev2_tmp')]
+    report_out = [
+            os.path.join(res_dir, f'{sample}_sc_allot.result'),
+            os.path.join(res_dir, f'{sample}_sc_taxonomy.report'),
+            os.path.join(res_dir, f'{sample}_sc_taxonomy.G.report'),
+            os.path.join(res_dir, 'matrix', 'raw'),
+            ]
+    ranks = parse_ranks(config.get('matrix_ranks'))
+    rank_out = [os.path.join(res_dir, 'matrix', f'kraken_{rank}') for rank in ranks]
+
+    # every stage takes the whole budget of `process` cpus, so the stages run one at a time. Only the
+    # plot process preflight leaves behind overlaps them, as a child rather than a thread next to the
+    # stage threads that fork workers
+    p = obj_pre.p
+    obj_pre.plots = []
+    scheduler = Scheduler(p)
+    if obj_pre.streaming:
+        scheduler.add('preflight', lambda: stages.run(
+            'preflight', preflight, config, pre_keys + ['krakenDb'], [fq1, fq2, kdb],
+            [reads_ctx, fumi_ctx, kreport, koutput], pre_tools + [config.get('kraken')]), cpus=p)
+        kraken_done = 'preflight'
+    else:
+        scheduler.add('preflight', lambda: stages.run(
+            'preflight', preflight, config, pre_keys, [fq1, fq2], [reads_ctx, fumi_ctx, fq_final], pre_tools), cpus=p)
+        scheduler.add('kraken', lambda: stages.run(
+            'kraken', kraken, config, ['krakenDb'], [fq_final, kdb], [kreport, koutput], [config.get('kraken')]),
+            deps=['preflight'], cpus=p)
+        kraken_done = 'kraken'
+    scheduler.add('classify', lambda: stages.run(
+        'classify', classify, config, ['braken_mode', 'batch_rollup', 'braken_store'],
+        [kreport, koutput, kdb], braken_out, [config.get('braken')]), deps=[kraken_done], cpus=p)
+    scheduler.add('report', lambda: stages.run(
+        'report', report, config, ['filter_threshold', 'mex_compresslevel', 'braken_store'],
+        braken_out + [reads_ctx, fumi_ctx], report_out), deps=['classify'], cpus=p)
+    if ranks:
+        scheduler.add('rank_matrix', lambda: stages.run(
+            'rank_matrix', rank_matrix, config, ['matrix_ranks', 'mex_compresslevel'],
+            [kreport, koutput], rank_out), deps=[kraken_done], cpus=p)
+    try:
+        scheduler.run()
+    finally:
+        obj_pre.wait_plots()
+
+
 def main():
     AP = argparse.ArgumentParser(
             description="microbiome scRNA seq analysis pipeline.",
             formatter_class=argparse.RawTextHelpFormatter,
             )
-    AP.add_argument('--cfg', metavar='', help='config file, refer to example for details', required=True)
+    AP.add_argument('--cfg', metavar='FILE', help='config file, refer to example for details', required=True)
     AP.add_argument('--report', action='store_true', help='Re-analysis with a specific cell number')
-    AP.add_argument('--cellnum', type=int, help='Number of cells')
+    AP.add_argument('--cellnum', type=int, nargs='+', help='Number of cells, several numbers share one run')
+    AP.add_argument('--profile', action='store_true', help='Also write a cProfile of each stage to Result/profile')
+    AP.add_argument('--cell', metavar='BARCODE', help='Print the classify output of one cell barcode and exit')
+    AP.add_argument('--level', default='S', choices=['S', 'G', 'kreport', 'log'], help='Which output --cell prints, default S')
 
     args = AP.parse_args()
+    # stage skips, stage times and the critical path are reported through logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
     fcfg = args.cfg
     config = read_config(fcfg)
 
+    if args.cell:
+        text = Report(config).cell_record(args.cell, args.level)
+        if text is None:
+            print(f'Error: no {args.level} record of cell {args.cell}.\n')
+            sys.exit(1)
+        sys.stdout.write(text)
+        return
+
     obj_pre = PreFlight(config)
+    res_dir = os.path.join(config['outdir'], 'Result')
+    fprofile = os.path.join(res_dir, f"{config['sample']}_profile.json")
+    if args.profile:
+        run_profile.prof_dir = os.path.join(res_dir, 'profile')
 
     if args.report:
         cell_num = args.cellnum
@@ -31,19 +144,18 @@ def main():
             print("Error: cellnum not provided.\n")
             AP.print_help()
             sys.exit(1)
-        obj_pre.output_fq(cell_num)
-        reporter = Report(config)
-        reporter.report()
-        reporter.report2(cell_num)
+        try:
+            for n in cell_num:
+                obj_pre.output_fq(n)
+            reporter = Report(config)
+            reporter.report()
+            reporter.report_cells(cell_num)
+        finally:
+            run_profile.save(fprofile)
 
     else:
-        fq_valid = obj_pre.run()
-
-        kreport, koutput = run_kraken(fq_valid, config)
-        
-        classifier = Classifier(config, kreport)
-        classifier.worker_pool(koutput)
-
-        reporter = Report(config)
-        reporter.report()
-
+        try:
+            run_stages(config, obj_pre)
+        finally:
+            # written on failure too, the last entries show how far the run got
+            run_profile.save(fprofile)
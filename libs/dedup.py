@@ -0,0 +1,80 @@
+import os
+import logging
+
+import numpy as np
+
+
+class Dedup:
+    # exact duplicate reads by a 64-bit fingerprint of the merged sequence, the first occurrence is kept
+    def __init__(self, tmp_dir, memory=2048):
+        self.tmp_dir = tmp_dir
+        # fingerprints the memory budget holds. Merging needs the old arrays and the merged one at once,
+        # so at most half of it is kept in memory before the keys are spilled to disk as a sorted run
+        self.budget = max((memory << 20) // 8, 1 << 20)
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.pending = []
+        self.pending_size = 0
+        self.runs = []
+        self.reads = 0
+        self.kept = 0
+
+    def seen(self, fps):
+        found = np.zeros(fps.size, dtype=bool)
+        for keys in [self.keys] + self.pending + self.runs:
+            if not keys.size:
+                continue
+            pos = np.minimum(np.searchsorted(keys, fps), keys.size - 1)
+            found |= keys[pos] == fps
+        return found
+
+    def add(self, keys):
+        # spill before the batch comes in, so no merge works on more than half the budget
+        if self.keys.size + self.pending_size + keys.size > self.budget // 2:
+            self.spill()
+        self.pending.append(keys)
+        self.pending_size += keys.size
+        # small batches are folded into the sorted keys once they reach a quarter of them
+        if self.pending_size > max(1 << 20, self.keys.size >> 2):
+            self.keys = self.merged()
+
+    def merged(self):
+        # sorted in place, so the peak is the old arrays plus one merged copy
+        keys = np.concatenate([self.keys] + self.pending)
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.pending = []
+        self.pending_size = 0
+        keys.sort()
+        return keys
+
+    def spill(self):
+        if not self.keys.size and not self.pending_size:
+            return
+        keys = self.merged()
+        frun = os.path.join(self.tmp_dir, f'dedup_run{len(self.runs)}.u64')
+        keys.tofile(frun)
+        self.runs.append(np.memmap(frun, dtype=np.uint64, mode='r'))
+
+    def keep(self, fps):
+        # first occurrence within the batch, then against everything seen before it
+        uniq, first = np.unique(fps, return_index=True)
+        new = ~self.seen(uniq)
+        keep = np.zeros(fps.size, dtype=bool)
+        keep[first[new]] = True
+        self.add(uniq[new])
+        return keep
+
+    def filter(self, out, fps, sizes):
+        keep = self.keep(fps)
+        self.reads += fps.size
+        self.kept += int(keep.sum())
+        if keep.all():
+            return out
+        mask = np.repeat(keep, sizes)
+        return np.frombuffer(out, dtype=np.uint8)[mask].tobytes()
+
+    def close(self):
+        fnames = [run.filename for run in self.runs]
+        self.runs = []
+        for fname in fnames:
+            os.remove(fname)
+        logging.info(f'dedup: {self.kept} of {self.reads} reads kept.')
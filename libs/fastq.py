@@ -0,0 +1,115 @@
+from collections import Counter, deque
+from functools import partial
+from hashlib import blake2b
+from multiprocessing import Pool
+
+import numpy as np
+
+
+def record_bounds(fname, n, block=1 << 20):
+    # byte offsets cutting the file into runs of n four-line records, the last one at the end of the file
+    need = 4 * n
+    buf = bytearray(block)
+    pos = 0
+    lines = 0
+    last = 0
+    with open(fname, 'rb') as fh:
+        while True:
+            size = fh.readinto(buf)
+            if not size:
+                break
+            count = buf.count(b'\n', 0, size)
+            if lines + count < need:
+                lines += count
+                pos += size
+                continue
+            ends = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8, count=size) == 10)
+            first = need - lines
+            for k in range(first - 1, ends.size, need):
+                last = pos + int(ends[k]) + 1
+                yield last
+            lines = (count - first) % need
+            pos += size
+    if pos > last:
+        yield pos
+
+
+def record_ranges(fname, n):
+    start = 0
+    for end in record_bounds(fname, n):
+        yield start, end
+        start = end
+
+
+def read_range(fname, start, end):
+    with open(fname, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+    return data
+
+
+def merge_pairs(fq1, range1, fq2, range2, bc_len=20, fingerprints=False):
+    # R1 + R2 sequence and quality under the R2 header, and the R1 barcode counts
+    lines1 = read_range(fq1, *range1).split(b'\n')
+    lines2 = read_range(fq2, *range2).split(b'\n')
+    n = 4 * (min(len(lines1), len(lines2)) // 4)
+    records = zip(lines2[0:n:4], lines1[1:n:4], lines2[1:n:4], lines1[3:n:4], lines2[3:n:4])
+    records = [b'%s\n%s%s\n+\n%s%s\n' % rec for rec in records]
+    counts = Counter([seq[:bc_len] for seq in lines1[1:n:4]])
+    counts = {cb.decode(): val for cb, val in counts.items()}
+    if not fingerprints:
+        return b''.join(records), counts
+
+    # merged sequence fingerprints and record sizes, for Dedup.filter
+    digests = [blake2b(seq1 + seq2, digest_size=8).digest() for seq1, seq2 in zip(lines1[1:n:4], lines2[1:n:4])]
+    fps = np.frombuffer(b''.join(digests), dtype=np.uint64)
+    sizes = np.fromiter(map(len, records), dtype=np.int64, count=len(records))
+    return b''.join(records), counts, fps, sizes
+
+
+def count_barcodes(fq1, range1, bc_len=20):
+    lines = read_range(fq1, *range1).split(b'\n')
+    n = 4 * (len(lines) // 4)
+    counts = Counter([seq[:bc_len] for seq in lines[1:n:4]])
+    return {cb.decode(): val for cb, val in counts.items()}
+
+
+def read_barcodes(fq1, process=1, chunk=100000):
+    # barcode counts of R1 alone, in the order merge_fastq would report them
+    read_counts = Counter()
+    with Pool(max(process, 1)) as pool:
+        for counts in pool.imap(partial(count_barcodes, fq1), record_ranges(fq1, chunk)):
+            read_counts.update(counts)
+    return read_counts
+
+
+def merge_batches(pool, fq1, fq2, process=1, chunk=100000, dedup=None):
+    # pool workers read and merge batches of records, yielded back in input order
+    batches = zip(record_ranges(fq1, chunk), record_ranges(fq2, chunk))
+    pending = deque()
+    for range1, range2 in batches:
+        pending.append(pool.apply_async(merge_pairs, (fq1, range1, fq2, range2, 20, dedup is not None)))
+        # a bounded number of batches in flight keeps memory flat
+        if len(pending) > 2 * process:
+            yield merged(pending.popleft().get(), dedup)
+    while pending:
+        yield merged(pending.popleft().get(), dedup)
+
+
+def merged(result, dedup):
+    # duplicates are dropped in input order, so the first copy of a read is the one kept
+    if dedup is None:
+        return result
+    out, counts, fps, sizes = result
+    return dedup.filter(out, fps, sizes), counts
+
+
+def merge_fastq(fq1, fq2, fout, process=1, chunk=100000, dedup=None):
+    read_counts = Counter()
+    with open(fout, 'wb') as fh, Pool(max(process, 1)) as pool:
+        for out, counts in merge_batches(pool, fq1, fq2, process, chunk, dedup):
+            fh.write(out)
+            read_counts.update(counts)
+    return read_counts
@@ -0,0 +1,268 @@
+import os
+import threading
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import sparse
+
+from .manifest import path_state
+from .matrix import CountMatrix, BinaryMatrix
+
+
+# 3-bit base codes, so barcodes up to 21 bp pack into one uint64
+BASES = np.full(256, 7, dtype=np.uint8)
+for i, base in enumerate(b'ACGTN'):
+    BASES[base] = i
+
+CACHE_VERSION = 1
+# stages running side by side parse the same kraken output once
+CACHE_LOCK = threading.Lock()
+
+
+class CellCounts:
+    def __init__(self, barcodes, tax_ids, matrix):
+        self.barcodes = barcodes
+        self.tax_ids = tax_ids
+        self.matrix = matrix
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def rows(self, rows):
+        return CellCounts([self.barcodes[i] for i in rows], self.tax_ids, self.matrix[rows])
+
+    def cell(self, i):
+        start, end = self.matrix.indptr[i], self.matrix.indptr[i + 1]
+        tax_ids = self.tax_ids
+        cols = self.matrix.indices[start:end].tolist()
+        vals = self.matrix.data[start:end].tolist()
+        return {tax_ids[j]: val for j, val in zip(cols, vals)}
+
+
+class Encoder:
+    def __init__(self):
+        self.index = {}
+        self.keys = []
+
+    def encode(self, values, labels=None):
+        # codes follow first appearance, so the result does not depend on chunking
+        if labels is None:
+            labels = values
+        uniq, first, inv = np.unique(values, return_index=True, return_inverse=True)
+        codes = np.empty(uniq.size, dtype=np.int64)
+        index = self.index
+        for j in np.argsort(first, kind='stable').tolist():
+            key = labels[first[j]].item()
+            code = index.get(key)
+            if code is None:
+                code = index[key] = len(self.keys)
+                self.keys.append(key)
+            codes[j] = code
+        return codes[inv]
+
+
+class Tally:
+    def __init__(self, limit=1 << 24):
+        self.limit = limit
+        self.keys = []
+        self.counts = []
+        self.size = 0
+
+    def add(self, keys, counts):
+        self.keys.append(keys)
+        self.counts.append(counts)
+        self.size += keys.size
+        if self.size > self.limit:
+            self.merge()
+
+    def merge(self):
+        if len(self.keys) == 1:
+            return self.keys[0], self.counts[0]
+        if not self.keys:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        uniq, inv = np.unique(np.concatenate(self.keys), return_inverse=True)
+        counts = np.bincount(inv, weights=np.concatenate(self.counts), minlength=uniq.size).astype(np.int64)
+        self.keys = [uniq]
+        self.counts = [counts]
+        self.size = uniq.size
+        # the limit only bounds the unmerged partials
+        self.limit = max(self.limit, 2 * uniq.size)
+        return uniq, counts
+
+
+def read_chunks(fname, start, end, chunk_size):
+    with open(fname, 'rb') as fh:
+        if start > 0:
+            fh.seek(start - 1)
+            fh.readline()
+        pos = fh.tell()
+        while pos < end:
+            data = fh.read(min(chunk_size, end - pos))
+            if not data:
+                break
+            if not data.endswith(b'\n'):
+                data += fh.readline()
+            pos = fh.tell()
+            yield data
+
+
+def gather(buf, starts, lens):
+    width = max(int(lens.max()), 1)
+    padded = np.concatenate([buf, np.zeros(width, dtype=np.uint8)])
+    field = np.lib.stride_tricks.sliding_window_view(padded, width)[starts]
+    pad = np.arange(width) >= lens[:, None]
+    field[pad] = 0
+    return field, pad
+
+
+def scan(data):
+    # barcode and tax_id of every line, located from the delimiter positions
+    buf = np.frombuffer(data, dtype=np.uint8)
+    tabs = np.flatnonzero(buf == 9)
+    if tabs.size < 3:
+        return None
+    ends = np.flatnonzero(buf == 10)
+    starts = np.r_[0, ends[:-1] + 1]
+    if tabs.size == 4 * ends.size:
+        # plain five-column output, the usual case
+        k = np.arange(0, tabs.size, 4)
+        ok = tabs[k] > starts
+    else:
+        k = np.searchsorted(tabs, starts)
+        ok = k + 2 < tabs.size
+        k = np.minimum(k, tabs.size - 3)
+    t1 = tabs[k]
+    t2 = tabs[k + 1]
+    t3 = tabs[k + 2]
+    ok &= (t3 < ends) & (t3 - t2 > 1)
+
+    # read name is <read id>_<barcode>
+    under = np.flatnonzero(buf == 95)
+    if not under.size:
+        return None
+    j = np.searchsorted(under, t2) - 1
+    u = under[np.maximum(j, 0)]
+    ok &= (j >= 0) & (u > t1)
+    if not ok.any():
+        return None
+    u, t2, t3 = u[ok], t2[ok], t3[ok]
+
+    lens = t3 - t2 - 1
+    tax, pad = gather(buf, t2 + 1, lens)
+    ok = (((tax >= 48) & (tax <= 57)) | pad).all(axis=1)
+    tax_ids = np.zeros(tax.shape[0], dtype=np.int64)
+    for col in range(tax.shape[1]):
+        live = col < lens
+        tax_ids[live] = tax_ids[live] * 10 + (tax[live, col] - 48)
+    u, t2, tax_ids = u[ok], t2[ok], tax_ids[ok]
+    if not tax_ids.size:
+        return None
+
+    lens = t2 - u - 1
+    bc, _ = gather(buf, u + 1, lens)
+    labels = np.ascontiguousarray(bc).view(f'S{bc.shape[1]}').ravel()
+    if bc.shape[1] <= 21 and (lens == bc.shape[1]).all():
+        codes = BASES[bc]
+        if (codes < 5).all():
+            keys = np.zeros(bc.shape[0], dtype=np.uint64)
+            for col in codes.T:
+                keys = (keys << np.uint64(3)) | col.astype(np.uint64)
+            return keys, labels, tax_ids
+    return labels, labels, tax_ids
+
+
+def parse_range(koutput, start, end, chunk_size=64 << 20):
+    barcodes = Encoder()
+    tax_ids = Encoder()
+    tally = Tally()
+    for data in read_chunks(koutput, start, end, chunk_size):
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        hits = scan(data)
+        if hits is None:
+            continue
+        bc_keys, bc_labels, tax_keys = hits
+        bc_codes = barcodes.encode(bc_keys, bc_labels)
+        tax_codes = tax_ids.encode(tax_keys)
+        keys, counts = np.unique((bc_codes << 32) | tax_codes, return_counts=True)
+        tally.add(keys, counts)
+
+    keys, counts = tally.merge()
+    return barcodes.keys, tax_ids.keys, keys, counts
+
+
+def split_ranges(fname, parts):
+    size = os.path.getsize(fname)
+    bounds = [size * i // parts for i in range(parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_kraken_output(koutput, process=1, chunk_size=64 << 20):
+    ranges = split_ranges(koutput, max(process, 1))
+    if len(ranges) > 1:
+        with Pool(len(ranges)) as pool:
+            parts = pool.starmap(parse_range, [(koutput, s, e, chunk_size) for s, e in ranges])
+    else:
+        parts = [parse_range(koutput, s, e, chunk_size) for s, e in ranges]
+
+    # re-code each range onto the shared barcode and tax_id tables, in file order
+    barcodes = Encoder()
+    tax_ids = Encoder()
+    tally = Tally()
+    for bcs, taxs, keys, counts in parts:
+        if not bcs:
+            continue
+        bc_map = barcodes.encode(np.array(bcs))
+        tax_map = tax_ids.encode(np.array(taxs, dtype=np.int64))
+        keys = (bc_map[keys >> 32] << 32) | tax_map[keys & 0xffffffff]
+        tally.add(keys, counts)
+    keys, counts = tally.merge()
+
+    shape = (len(barcodes.keys), len(tax_ids.keys))
+    matrix = sparse.csr_matrix((counts, (keys >> 32, keys & 0xffffffff)), shape=shape)
+    matrix.sum_duplicates()
+    return CellCounts(
+            [bc.decode() for bc in barcodes.keys],
+            [str(tax_id) for tax_id in tax_ids.keys],
+            matrix)
+
+
+def cache_meta(koutput):
+    return {'kind': 'kraken_counts', 'version': CACHE_VERSION, 'source': path_state(koutput)}
+
+
+def read_cache(fcache, koutput):
+    try:
+        mat = BinaryMatrix(fcache)
+    except (OSError, ValueError):
+        return None
+    if mat.meta != cache_meta(koutput):
+        return None
+    # the taxon x cell csc arrays are the cell x taxon csr matrix, used as mapped
+    arrays = mat.arrays
+    matrix = sparse.csr_matrix((arrays['csc_data'], arrays['csc_indices'], arrays['csc_indptr']),
+            shape=(mat.shape[1], mat.shape[0]))
+    return CellCounts(mat.barcodes, mat.features, matrix)
+
+
+def write_cache(bc_counts, fcache, koutput):
+    m = bc_counts.matrix.tocoo()
+    counts = CountMatrix.from_arrays(m.col, m.row, m.data, bc_counts.tax_ids, bc_counts.barcodes)
+    outdir, fname = os.path.split(fcache)
+    tmp = f'{fname}.{os.getpid()}.tmp'
+    counts.save_binary(outdir, tmp, cache_meta(koutput))
+    os.replace(os.path.join(outdir, tmp), fcache)
+
+
+def load_kraken_output(koutput, process=1, cache=True):
+    # per-cell counts from a binary cache next to the kraken output, the text is parsed
+    # only when the cache is missing or older than the output it was made from
+    if not cache:
+        return read_kraken_output(koutput, process)
+    fcache = f'{koutput}.counts.bin'
+    with CACHE_LOCK:
+        bc_counts = read_cache(fcache, koutput)
+        if bc_counts is None:
+            bc_counts = read_kraken_output(koutput, process)
+            write_cache(bc_counts, fcache, koutput)
+    return bc_counts
@@ -0,0 +1,83 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+
+class Manifest:
+    # what went into and came out of every pipeline stage, a stage is skipped when neither changed since it last finished
+    def __init__(self, fname, reuse=True):
+        self.fname = fname
+        # with reuse off every stage runs, the manifest is still kept up to date
+        self.reuse = reuse
+        self.stages = {}
+        if os.path.exists(fname):
+            with open(fname) as fh:
+                self.stages = json.load(fh)
+
+    def signature(self, config, keys=(), inputs=(), tools=()):
+        # config values, input file stats and the stat of each tool binary standing in for its version
+        state = {
+                'config': {key: config.get(key) for key in keys},
+                'inputs': {path: path_state(path) for path in inputs if path},
+                'tools': {tool: path_state(shutil.which(tool) or tool) for tool in tools if tool},
+                }
+        return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    def done(self, name, signature):
+        entry = self.stages.get(name)
+        if not self.reuse or not entry or entry['state'] != 'done' or entry['signature'] != signature:
+            return False
+        return all(path_state(path) == state for path, state in entry['outputs'].items())
+
+    def partial(self, name, signature):
+        # started on these very inputs and stopped before it finished
+        entry = self.stages.get(name)
+        return self.reuse and bool(entry) and entry['state'] == 'running' and entry['signature'] == signature
+
+    def start(self, name, signature):
+        self.stages[name] = {'state': 'running', 'signature': signature, 'outputs': {}}
+        self.save()
+
+    def finish(self, name, outputs):
+        entry = self.stages[name]
+        entry['state'] = 'done'
+        entry['outputs'] = {path: path_state(path) for path in outputs}
+        self.save()
+
+    def save(self):
+        tmp = f'{self.fname}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.stages, fh, indent=1, sort_keys=True)
+        os.replace(tmp, self.fname)
+
+    def run(self, name, func, config, keys=(), inputs=(), outputs=(), tools=()):
+        # func gets resume=True when the same inputs were left half done
+        signature = self.signature(config, keys, inputs, tools)
+        if self.done(name, signature):
+            logging.info(f'{name}: inputs unchanged, skipped.')
+            return False
+        resume = self.partial(name, signature)
+        self.start(name, signature)
+        func(resume)
+        self.finish(name, outputs)
+        return True
+
+
+def path_state(path):
+    # [size, mtime] of a file, [files, bytes, latest mtime] over a directory tree, None if missing
+    if os.path.isdir(path):
+        count = size = mtime = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                st = os.stat(os.path.join(root, name))
+                count += 1
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime_ns)
+        return [count, size, mtime]
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
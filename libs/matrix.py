@@ -1,59 +1,211 @@
 import os
 import sys
 import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from scipy import sparse, io
 from scipy.sparse import csr_matrix
 
 
+BINARY_MAGIC = b'SCMMAT01'
+
+
 class CountMatrix:
     def __init__(self, bc_counts, features):
-        self.bc_counts = bc_counts
         self.barcodes = list(bc_counts.keys())
-        self.features = features
-
-        self.to_matrix()
-
-    def to_matrix(self):
+        self.features = list(features)
+
+        f_index = {fet: i for i, fet in enumerate(self.features)}
+        rows = []
+        cols = []
+        data = []
+        for j, counts in enumerate(bc_counts.values()):
+            for fet, val in counts.items():
+                i = f_index.get(fet)
+                if i is None or not val:
+                    continue
+                rows.append(i)
+                cols.append(j)
+                data.append(val)
+
+        self.to_matrix(rows, cols, data)
+
+    @classmethod
+    def from_arrays(cls, rows, cols, data, features, barcodes):
+        # rows index features and cols index barcodes, duplicates are summed
+        obj = cls.__new__(cls)
+        obj.barcodes = list(barcodes)
+        obj.features = list(features)
+        obj.to_matrix(rows, cols, data)
+        return obj
+
+    def to_matrix(self, rows, cols, data):
         self.rows = len(self.features)
         self.cols = len(self.barcodes)
 
-        mat = np.zeros([self.rows, self.cols])
-
-        for i, feature in enumerate(self.features):
-            for j, bc in enumerate(self.barcodes):
-                try:
-                    counts = self.bc_counts[bc][feature]
-                    mat[i, j] = counts
-                except KeyError:
-                    continue
-        csr_mat = csr_matrix(mat)
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        data = np.asarray(data, dtype=np.int64)
+        m = sparse.coo_matrix((data, (rows, cols)), shape=(self.rows, self.cols))
+        csr_mat = m.tocsr()
+        csr_mat.eliminate_zeros()
         self.m = csr_mat.tocoo()
 
-    def save_mex(self, outdir):
+    def save_mex(self, outdir, compresslevel=6, threads=4, block=1 << 20):
 
         metadata = '%%MatrixMarket matrix coordinate real general\n'
         out_matrix_fn = os.path.join(outdir, 'matrix.mtx.gz')
         out_barcodes_fn = os.path.join(outdir, 'barcodes.tsv.gz')
         out_features_fn = os.path.join(outdir, 'features.tsv.gz')
 
-        with gzip.open(out_barcodes_fn, 'wb') as fh:
-            for bc in self.barcodes:
-                fh.write(f'{bc}\n'.encode())
-
-        with gzip.open(out_features_fn, 'wb') as fh:
-            for fet in self.features:
-                fh.write(f'{fet}\n'.encode())
-
-        with gzip.open(out_matrix_fn, 'wb') as fh:
-            fh.write(np.compat.asbytes(metadata))
-            fh.write(np.compat.asbytes("%\n"))
-            fh.write(np.compat.asbytes('%i %i %i\n' % (self.rows, self.cols, self.m.nnz)))
-
-            # write row, col, val in 1-based indexing
-            for r, c, d in zip(self.m.row+1, self.m.col+1, self.m.data):
-                fh.write(np.compat.asbytes(("%i %i %i\n" % (r, c, d))))
-
-
-
+        with gzip.open(out_barcodes_fn, 'wb', compresslevel) as fh:
+            fh.write(''.join(f'{bc}\n' for bc in self.barcodes).encode())
+
+        with gzip.open(out_features_fn, 'wb', compresslevel) as fh:
+            fh.write(''.join(f'{fet}\n' for fet in self.features).encode())
+
+        # write row, col, val in 1-based indexing, each block compressed
+        # on its own as an independent gzip member of the same file
+        row = self.m.row
+        col = self.m.col
+        data = self.m.data.astype(np.int64)
+
+        def compress_block(start):
+            end = min(start + block, self.m.nnz)
+            triplets = np.empty((end - start, 3), dtype=np.int64)
+            triplets[:, 0] = row[start:end] + 1
+            triplets[:, 1] = col[start:end] + 1
+            triplets[:, 2] = data[start:end]
+            text = (b'%d %d %d\n' * (end - start)) % tuple(triplets.ravel().tolist())
+            return gzip.compress(text, compresslevel, mtime=0)
+
+        header = metadata + '%\n' + f'{self.rows} {self.cols} {self.m.nnz}\n'
+        with open(out_matrix_fn, 'wb') as fh:
+            fh.write(gzip.compress(header.encode(), compresslevel, mtime=0))
+            with ThreadPoolExecutor(max(threads, 1)) as executor:
+                for member in executor.map(compress_block, range(0, self.m.nnz, block)):
+                    fh.write(member)
+
+    def save_binary(self, outdir, fname='matrix.bin', meta=None):
+        csc = self.m.tocsc()
+        csr = self.m.tocsr()
+        for mat in (csc, csr):
+            mat.sort_indices()
+        data_dtype = np.int32 if not csr.nnz or csr.data.max() < 2 ** 31 else np.int64
+
+        barcodes, barcode_offsets = encode_names(self.barcodes)
+        features, feature_offsets = encode_names(self.features)
+        arrays = {
+                'csc_indptr': csc.indptr.astype(np.int64),
+                'csc_indices': csc.indices.astype(np.int32),
+                'csc_data': csc.data.astype(data_dtype),
+                'csr_indptr': csr.indptr.astype(np.int64),
+                'csr_indices': csr.indices.astype(np.int32),
+                'csr_data': csr.data.astype(data_dtype),
+                'barcode_offsets': barcode_offsets,
+                'barcodes': barcodes,
+                'feature_offsets': feature_offsets,
+                'features': features,
+                }
+
+        # arrays follow the header, each on a 64-byte boundary
+        layout = {}
+        offset = 0
+        for key, arr in arrays.items():
+            layout[key] = {'offset': offset, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+            offset += (arr.nbytes + 63) // 64 * 64
+        header = {'shape': [self.rows, self.cols], 'nnz': int(csr.nnz), 'arrays': layout}
+        # anything the writer wants to find again, such as what the matrix was built from
+        if meta:
+            header['meta'] = meta
+        header = json.dumps(header).encode()
+        start = (len(BINARY_MAGIC) + 8 + len(header) + 63) // 64 * 64
+
+        with open(os.path.join(outdir, fname), 'wb') as fh:
+            fh.write(BINARY_MAGIC)
+            fh.write(np.uint64(len(header)).tobytes())
+            fh.write(header)
+            for key, arr in arrays.items():
+                fh.seek(start + layout[key]['offset'])
+                fh.write(arr.tobytes())
+            fh.truncate(start + offset)
+
+
+def encode_names(names):
+    blob = [name.encode() for name in names]
+    offsets = np.zeros(len(blob) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in blob], out=offsets[1:])
+    return np.frombuffer(b''.join(blob), dtype=np.uint8), offsets
+
+
+class BinaryMatrix:
+    def __init__(self, fname):
+        with open(fname, 'rb') as fh:
+            magic = fh.read(len(BINARY_MAGIC))
+            if magic != BINARY_MAGIC:
+                raise ValueError(f'{fname} is not a scMeta binary matrix')
+            size = int(np.frombuffer(fh.read(8), dtype=np.uint64)[0])
+            header = json.loads(fh.read(size))
+        start = (len(BINARY_MAGIC) + 8 + size + 63) // 64 * 64
+
+        self.fname = fname
+        self.shape = tuple(header['shape'])
+        self.nnz = header['nnz']
+        self.meta = header.get('meta', {})
+        self.arrays = {}
+        for key, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if not np.prod(shape):
+                self.arrays[key] = np.zeros(shape, dtype=spec['dtype'])
+                continue
+            self.arrays[key] = np.memmap(fname, dtype=spec['dtype'], mode='r',
+                    offset=start + spec['offset'], shape=shape)
+        self._barcodes = None
+        self._features = None
+
+    def name(self, key, i):
+        offsets = self.arrays[f'{key}_offsets']
+        return self.arrays[f'{key}s'][offsets[i]:offsets[i + 1]].tobytes().decode()
+
+    def names(self, key):
+        offsets = self.arrays[f'{key}_offsets']
+        blob = self.arrays[f'{key}s'].tobytes()
+        bounds = offsets.tolist()
+        return [blob[a:b].decode() for a, b in zip(bounds[:-1], bounds[1:])]
+
+    @property
+    def barcodes(self):
+        if self._barcodes is None:
+            self._barcodes = self.names('barcode')
+        return self._barcodes
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = self.names('feature')
+        return self._features
+
+    def take(self, layout, idx):
+        # gathers only the index/data ranges of the selected columns (csc) or rows (csr)
+        indptr = self.arrays[f'{layout}_indptr']
+        idx = np.asarray(idx, dtype=np.int64)
+        starts = indptr[idx]
+        lens = indptr[idx + 1] - starts
+        new_indptr = np.zeros(idx.size + 1, dtype=np.int64)
+        np.cumsum(lens, out=new_indptr[1:])
+        pos = np.repeat(starts - new_indptr[:-1], lens) + np.arange(new_indptr[-1])
+        return self.arrays[f'{layout}_data'][pos], self.arrays[f'{layout}_indices'][pos], new_indptr
+
+    def cells(self, idx):
+        data, indices, indptr = self.take('csc', idx)
+        return sparse.csc_matrix((data, indices, indptr), shape=(self.shape[0], len(indptr) - 1))
+
+    def taxa(self, idx):
+        data, indices, indptr = self.take('csr', idx)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, self.shape[1]))
+
+    def to_count_matrix(self):
+        m = self.cells(np.arange(self.shape[1]))
+        return CountMatrix.from_arrays(*sparse.find(m), self.features, self.barcodes)
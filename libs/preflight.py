@@ -1,15 +1,20 @@
 import os
 import sys
+import time
+import logging
 import subprocess as sp
-from collections import defaultdict
+from multiprocessing import Process
 
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-from pyfastx import Fastq
+# pandas, pyfastx and the plotting libraries take seconds to import, they are loaded where they are used
 #from kneed import KneeLocator
 
-from .utils import read_config, readme_parser, dir_check, file_check
+from .cellcall import call_cells
+from .cellindex import CellIndex
+from .dedup import Dedup
+from .fastq import merge_fastq, merge_batches, read_barcodes
+from .runprofile import run_profile
+from .stream import Stream, write_stream
+from .utils import read_config, readme_parser, dir_check, file_check, is_on
 
 
 
@@ -25,30 +30,131 @@ class PreFlight:
         self.res_dir = os.path.join(proj_dir, 'Result')
         dir_check(self.res_dir)
 
+        self.p = int(self.config.get('process', 4))
+        # stream mode chains the stages through pipes, only artifacts in stream_keep stay on disk
+        self.streaming = is_on(self.config.get('stream'))
+        self.stream_keep = set(filter(None, self.config.get('stream_keep', '').split(',')))
+        self.stream = None
+        self.stream_out = None
+        # native dedup drops exact duplicates while merging, in place of nubeam-dedup
+        self.native_dedup = self.config.get('dedup_mode') == 'native'
+        self.dedup_mem = int(self.config.get('dedup_mem', 2048))
+        self.cell_index = is_on(self.config.get('cell_index'))
+        # cell_num=auto picks the barcodes sent to kraken from the read count curve
+        self.auto_cells = self.config.get('cell_num') == 'auto'
+        self.cell_num = 0 if self.auto_cells else int(self.config.get('cell_num', 50000))
+        # set to a list to queue the scatter plots for start_plots instead of drawing them in place
+        self.plots = None
+        self.plot_job = None
+
     def run(self):
+        if self.streaming:
+            return self.run_stream()
         prededup = self.pre_dedup()
-        fq_dedup = self.dedup(prededup)
-        fq_valid = self.ready_fq(fq_dedup)
+        if self.native_dedup:
+            fq_dedup = prededup
+        else:
+            fq_dedup = self.dedup(prededup)
+        fq_valid = self.ready_fq(fq_dedup, self.cell_num)
         return fq_valid
 
-    def output_fq(self, cell_num):
+    def run_stream(self):
+        fq1 = os.path.join(self.data_dir, f'{self.sample}_1.fq')
+        fq2 = os.path.join(self.data_dir, f'{self.sample}_2.fq')
+        prededup = os.path.join(self.data_dir, f'{self.sample}.prededup.fq')
         fq_dedup = os.path.join(self.data_dir, f'{self.sample}.dedup.fq')
-        reads_ctx = os.path.join(self.data_dir, f'{self.sample}_read_counts.tsv')
-        fumi_ctx = os.path.join(self.data_dir, f'{self.sample}_UMI_counts.tsv')
-        prefix = os.path.join(self.data_dir, f'{self.sample}_{cell_num}')
+        fq_final_1 = os.path.join(self.data_dir, f'{self.sample}_final_1.fq')
+        fq_final = os.path.join(self.data_dir, f'{self.sample}_final_2.fq')
+        prefix = os.path.join(self.data_dir, self.sample)
 
-        dir_name = os.path.abspath(os.path.dirname(__file__))
-        reads_retriev = os.path.join(dir_name, 'readsRetriev2')
+        # readsRetriev2_tmp needs the read counts before the first record arrives
+        read_counts = read_barcodes(fq1, self.p)
+        reads_ctx = self.write_read_counts(read_counts)
+
+        stream = Stream()
+        pool = stream.pool(self.p)
+        dedup = None
+        merge_out, keep_name = prededup, 'prededup'
+        if self.native_dedup:
+            dedup = Dedup(self.data_dir, self.dedup_mem)
+            merge_out, keep_name = fq_dedup, 'dedup'
+        stream.fifo(merge_out)
+        outs = [merge_out]
+        if keep_name in self.stream_keep:
+            outs.append(stream.keep(merge_out))
+        batches = (out for out, counts in merge_batches(pool, fq1, fq2, self.p, dedup=dedup))
+        stream.thread('merge', self.stream_merge, batches, outs, dedup)
+
+        if dedup is None:
+            stream.fifo(fq_dedup)
+            dedup_out = fq_dedup
+            if 'dedup' in self.stream_keep:
+                dedup_out = stream.fifo(f'{fq_dedup}.in')
+                stream.pump('dedup', dedup_out, [stream.keep(fq_dedup), fq_dedup])
+            stream.spawn('nubeam-dedup', [self.config['nubeam_dedup'], '-i', prededup, '-o', dedup_out])
+
+        stream.fifo(fq_final_1)
+        stream.fifo(fq_final)
+        keep_1 = stream.keep(fq_final_1) if 'final_1' in self.stream_keep else os.devnull
+        stream.pump('final_1', fq_final_1, [keep_1])
+        fq_valid = fq_final
+        if 'final_2' in self.stream_keep:
+            fq_valid = stream.fifo(f'{fq_final}.out')
+            stream.pump('final_2', fq_final, [stream.keep(fq_final), fq_valid])
 
-        sp.run([
-            reads_retriev,
-            '-bc', fumi_ctx,
-            '-cells', str(cell_num),
+        dir_name = os.path.abspath(os.path.dirname(__file__))
+        stream.spawn('readsRetriev2_tmp', [
+            os.path.join(dir_name, 'readsRetriev2_tmp'),
+            '-bc', reads_ctx,
+            '-cells', str(self.cell_num),
             '-fq', fq_dedup,
             '-o', prefix,
-            '-tab', 'off'
+            '-tab', 'on'
             ])
 
+        stream.watch()
+        self.stream = stream
+        self.stream_out = fq_valid
+        return fq_valid
+
+    def stream_merge(self, batches, outs, dedup):
+        write_stream(batches, outs)
+        if dedup is not None:
+            dedup.close()
+
+    def wait(self):
+        # called once the consumer of run()'s output is done, raises if any stage failed
+        if self.stream is None:
+            return
+        self.stream.wait([self.stream_out])
+        self.stream = None
+
+        fumi_ctx = os.path.join(self.data_dir, f'{self.sample}_UMI_counts.tsv')
+        self.plot(fumi_ctx, 'UMI')
+
+    def output_fq(self, cell_num):
+        fq_dedup = os.path.join(self.data_dir, f'{self.sample}.dedup.fq')
+        reads_ctx = os.path.join(self.data_dir, f'{self.sample}_read_counts.tsv')
+        fumi_ctx = os.path.join(self.data_dir, f'{self.sample}_UMI_counts.tsv')
+        prefix = os.path.join(self.data_dir, f'{self.sample}_{cell_num}')
+
+        if self.cell_index:
+            # the first call regroups the dedup fastq by cell, later ones read a prefix of it
+            index = CellIndex(fq_dedup, fumi_ctx, os.path.join(self.data_dir, self.sample))
+            index.extract(cell_num, f'{prefix}_final.fq')
+        else:
+            dir_name = os.path.abspath(os.path.dirname(__file__))
+            reads_retriev = os.path.join(dir_name, 'readsRetriev2')
+
+            sp.run([
+                reads_retriev,
+                '-bc', fumi_ctx,
+                '-cells', str(cell_num),
+                '-fq', fq_dedup,
+                '-o', prefix,
+                '-tab', 'off'
+                ])
+
         self.violin_plot(fumi_ctx, cell_num, 'UMI')
         self.violin_plot(reads_ctx, cell_num, 'Reads')
         return None
@@ -69,7 +175,6 @@ class PreFlight:
         return fqout
 
     def pre_dedup(self):
-        read_counts = defaultdict(int)
         fq1 = os.path.join(self.data_dir, f'{self.sample}_1.fq')
         fq2 = os.path.join(self.data_dir, f'{self.sample}_2.fq')
 
@@ -77,23 +182,22 @@ class PreFlight:
         file_check(fq2)
 
         prededup = os.path.join(self.data_dir, f'{self.sample}.prededup.fq')
-        fh = open(prededup, 'w')
-        for item1, item2 in zip(Fastq(fq1, build_index=False, full_name=True), \
-            Fastq(fq2, build_index=False, full_name=True)):
-            id_1, seq_1, qual_1 = item1
-            id_2, seq_2, qual_2 = item2
-
-            #if len(seq_2) < 60:
-            #    continue
-            cb = seq_1[0:20]
-            read_counts[cb] += 1
-
-            new_seq = seq_1 + seq_2
-            new_qual = qual_1 + qual_2
-
-            fh.write(f'@{id_2}\n{new_seq}\n+\n{new_qual}\n')
-        fh.close()
+        dedup = None
+        if self.native_dedup:
+            # duplicates are dropped as the pairs are merged, so this already is the dedup fastq
+            prededup = os.path.join(self.data_dir, f'{self.sample}.dedup.fq')
+            dedup = Dedup(self.data_dir, self.dedup_mem)
+        # R1 and R2 are merged in batches of records across worker processes
+        with run_profile.stage('pre_dedup', [fq1, fq2], [prededup]) as entry:
+            read_counts = merge_fastq(fq1, fq2, prededup, self.p, dedup=dedup)
+            entry['records'] = sum(read_counts.values())
+            if dedup is not None:
+                dedup.close()
+                entry['kept'] = dedup.kept
+        self.write_read_counts(read_counts)
+        return prededup
 
+    def write_read_counts(self, read_counts):
         reads_ctx = os.path.join(self.data_dir, f'{self.sample}_read_counts.tsv')
         
         x = []
@@ -105,19 +209,34 @@ class PreFlight:
                 y.append(val)
                 x.append(n)
                 n += 1
-        self.scatter_plot(reads_ctx, 'reads')
-        return prededup
+        if self.auto_cells:
+            self.cell_num = self.call_cells(y)
+        self.plot(reads_ctx, 'reads', self.cell_num if self.auto_cells else None)
+        return reads_ctx
+
+    def call_cells(self, counts):
+        lower = int(self.config.get('cell_lower', 100))
+        fdr = float(self.config.get('cell_fdr', 0.01))
+        result = call_cells(counts, lower, fdr)
+
+        fcall = os.path.join(self.data_dir, f'{self.sample}_cell_calling.tsv')
+        with open(fcall, 'w') as fh:
+            for key, val in result.items():
+                fh.write(f'{key}\t{val}\n')
+        logging.info(f"{result['cells']} cells called from {result['barcodes']} barcodes.")
+        return max(result['cells'], 1)
         
     def dedup(self, prededup):
         fq_dedup = os.path.join(self.data_dir, f'{self.sample}.dedup.fq')
 
         nubeam_dedeup = self.config['nubeam_dedup']
 
-        sp.run([
-            nubeam_dedeup,
-            '-i', prededup,
-            '-o', fq_dedup
-        ])
+        with run_profile.stage('dedup', [prededup], [fq_dedup]):
+            sp.run([
+                nubeam_dedeup,
+                '-i', prededup,
+                '-o', fq_dedup
+            ])
 
         return fq_dedup
 
@@ -130,16 +249,18 @@ class PreFlight:
         dir_name = os.path.abspath(os.path.dirname(__file__))
         reads_retriev = os.path.join(dir_name, 'readsRetriev2_tmp')
 
-        sp.run([
-            reads_retriev,
-            '-bc', reads_ctx,
-            '-cells', str(cell_num),
-            '-fq', fq_dedup,
-            '-o', prefix,
-            '-tab', 'on'
-            ])
+        with run_profile.stage('ready_fq', [fq_dedup], [fq_final, f'{prefix}_final_1.fq', fumi_ctx]) as entry:
+            sp.run([
+                reads_retriev,
+                '-bc', reads_ctx,
+                '-cells', str(cell_num),
+                '-fq', fq_dedup,
+                '-o', prefix,
+                '-tab', 'on'
+                ])
+            entry['records'] = cell_num
 
-        self.scatter_plot(fumi_ctx, 'UMI')
+        self.plot(fumi_ctx, 'UMI')
 
         return fq_final
 
@@ -161,6 +282,7 @@ class PreFlight:
                 cells.append(arr[0])
                 n += 1
         
+        from pyfastx import Fastq
         with open(fq_valid, 'w') as fh:
             for item in Fastq(fq_final, build_index=False, full_name=True):
                 id_, seq, qual = item
@@ -170,7 +292,43 @@ class PreFlight:
                 fh.write(f'@{id_}\n{seq}\n+\n{qual}\n')
         return fq_valid
 
-    def scatter_plot(self, fdata, ylabel):
+    def plot(self, *args):
+        if self.plots is None:
+            self.scatter_plot(*args)
+        else:
+            self.plots.append(args)
+
+    def start_plots(self):
+        # a niced child process draws them in the background, on cpu time the pipeline stages leave idle.
+        # it is forked while no other thread is at work, later stages fork their own workers while it runs
+        plots, self.plots = self.plots, []
+        if not plots:
+            return
+        p = Process(target=self.render, args=(plots, ))
+        p.start()
+        self.plot_job = (p, len(plots), time.time())
+
+    def wait_plots(self):
+        if self.plot_job is None:
+            return
+        p, records, started = self.plot_job
+        self.plot_job = None
+        p.join()
+        # cpu counters of a background child can not be told apart from those of the stages
+        run_profile.add({'stage': 'plots', 'records': records, 'start': round(started - run_profile.started, 3),
+                'wall': round(time.time() - started, 3)})
+        if p.exitcode:
+            raise RuntimeError(f'plot process exited with code {p.exitcode}')
+
+    def render(self, plots):
+        os.nice(10)
+        for args in plots:
+            self.scatter_plot(*args)
+
+    def scatter_plot(self, fdata, ylabel, cells=None):
+        import pandas as pd
+        import matplotlib.pyplot as plt
+
         df = pd.read_csv(fdata, header=None, sep='\t')
         df['Index'] = range(1, df.shape[0]+1)
         #kn = KneeLocator(x, y, curve='convex', direction='decreasing')
@@ -189,12 +347,18 @@ class PreFlight:
         ylim = max(y)
         #if kn.knee:
         #    ax.vlines(kn.knee, 0, ylim, colors = 'blue', linestyles = 'dashed')
+        if cells:
+            ax.vlines(cells, 0, ylim, colors = 'blue', linestyles = 'dashed')
         fig.tight_layout()
         plt.savefig(os.path.join(self.data_dir, f'{self.sample}_{ylabel}_ScatterPlot.png'))
 
         return None
 
     def violin_plot(self, fdata, cell_num, ylabel):
+        import pandas as pd
+        import seaborn as sns
+        import matplotlib.pyplot as plt
+
         df = pd.read_csv(fdata, header=None, sep='\t')
         df = df.iloc[0:cell_num, :]
         values = df.loc[:, 1]
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+
+from .classify import Taxanomy
+from .koutput import load_kraken_output
+from .matrix import CountMatrix
+from .runprofile import run_profile
+from .utils import dir_check, is_on
+
+
+def parse_ranks(value):
+    # comma separated kraken rank codes such as S,G,F,O, empty for none
+    return [rank.strip() for rank in (value or '').split(',') if rank.strip()]
+
+
+class RankMatrix:
+    # cell x taxon read counts at any kraken rank, straight from the per-read assignments of the kraken output
+    def __init__(self, config, kreport):
+        self.config = config
+        self.p = int(self.config.get('process', 4))
+        self.compresslevel = int(self.config.get('mex_compresslevel', 6))
+        self.ranks = parse_ranks(self.config.get('matrix_ranks'))
+        self.koutput_cache = is_on(self.config.get('koutput_cache', 'on'))
+        self.mat_dir = os.path.join(self.config['outdir'], 'Result', 'matrix')
+        self.taxan = Taxanomy(kreport)
+
+    def outdirs(self):
+        return [os.path.join(self.mat_dir, f'kraken_{rank}') for rank in self.ranks]
+
+    def counts(self, bc_counts, rank):
+        # every read counts towards its nearest ancestor-or-self of `rank`, reads assigned above it are left out
+        m = bc_counts.matrix.tocoo()
+        node = self.taxan.nodes(bc_counts.tax_ids)[m.col]
+        owner = np.where(node >= 0, self.taxan.level_map(rank)[np.maximum(node, 0)], -1)
+        keep = owner >= 0
+        nodes, codes = np.unique(owner[keep], return_inverse=True)
+        # taxa sharing a name share a feature, as in the species matrix
+        names = {}
+        feature = np.array([names.setdefault(self.taxan.names[j].replace(' ', '_'), len(names)) for j in nodes.tolist()],
+                dtype=np.int64)
+        return CountMatrix.from_arrays(feature[codes], m.row[keep], m.data[keep], names, bc_counts.barcodes)
+
+    def run(self, koutput):
+        if not self.ranks:
+            return []
+        outdirs = self.outdirs()
+        outputs = [os.path.join(outdir, fname) for outdir in outdirs
+                for fname in ('matrix.mtx.gz', 'barcodes.tsv.gz', 'features.tsv.gz', 'matrix.bin')]
+        with run_profile.stage('rank_matrix', [koutput], outputs) as entry:
+            # one pass over the kraken output serves every rank
+            bc_counts = load_kraken_output(koutput, self.p, self.koutput_cache)
+            entry['records'] = 0
+            for rank, outdir in zip(self.ranks, outdirs):
+                dir_check(outdir)
+                matrix = self.counts(bc_counts, rank)
+                matrix.save_mex(outdir, self.compresslevel, self.p)
+                matrix.save_binary(outdir)
+                entry['records'] += int(matrix.m.nnz)
+        return outdirs
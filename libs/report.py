@@ -1,153 +1,236 @@
 import os
+import io
 import sys
-from collections import Counter, defaultdict
+import csv
+from collections import Counter
 
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+import numpy as np
+# pandas and the plotting libraries take seconds to import, they are loaded where they are used
 
-from .matrix import CountMatrix
-from .utils import read_config, readme_parser, dir_check
+from .matrix import CountMatrix, BinaryMatrix
+from .runprofile import run_profile
+from .scheduler import Scheduler
+from .store import RecordStore
+from .utils import read_config, readme_parser, dir_check, is_on
 
 
+BRAKEN_COLUMNS = ['name', 'taxonomy_id', 'taxonomy_lvl', 'kraken_assigned_reads', 'added_reads', 'new_est_reads', 'fraction_total_reads']
+
 class Report:
     def __init__(self, config):
         self.config = config
         filter_thresh = config.get('filter_threshold', None)
         try:
-            self.filter_tresh = int(filter_tresh.strip())
+            self.filter_thresh = int(filter_thresh.strip())
             self.do_filter = True
         except Exception:
             self.do_filter =False
 
+        self.p = int(self.config.get('process', 4))
+        self.compresslevel = int(self.config.get('mex_compresslevel', 6))
+
         self.sample = self.config['sample']
         proj_dir = self.config['outdir']
         self.res_dir = os.path.join(proj_dir, 'Result')
         self.data_dir = os.path.join(proj_dir, 'clean_data')
         self.braken_dir = os.path.join(self.res_dir, 'braken_report')
         self.braken_dir_g = os.path.join(self.res_dir, 'braken_report_g')
+        self.tmp_dir = os.path.join(self.res_dir, 'braken_tmp')
         self.mat_dir = os.path.join(self.res_dir, 'matrix')
+        self.store = is_on(self.config.get('braken_store'))
+        self.store_dir = os.path.join(self.res_dir, 'braken_store')
         dir_check(self.mat_dir)
 
     def report(self):
         fresult = os.path.join(self.res_dir, f'{self.sample}_sc_allot.result')
         freport = os.path.join(self.res_dir, f'{self.sample}_sc_taxonomy.report')
         freportg = os.path.join(self.res_dir, f'{self.sample}_sc_taxonomy.G.report')
-        fh1 = open(fresult, 'w')
-        fh2 = open(freport, 'w')
-        fh3 = open(freportg, 'w')
-        fh1.write("barcode\tname\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n")
-        fh2.write("barcode\tname\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n")
-        fh3.write("barcode\tname\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n")
-
-        bc_counts = defaultdict(lambda : defaultdict(int))
-        features = set()
-
-        for bout in os.listdir(self.braken_dir):
-            fbout = os.path.join(self.braken_dir, bout)
-            if not os.path.exists(fbout):
-                continue
-            cb, _ = bout.split('.')
-            items = []
-            with open(fbout) as fh4:
-                fh4.readline()
-                for line in fh4:
-                    arr = line.strip().split('\t')
-                    feature = arr[0].replace(' ', '_')
-                    bc_counts[cb][feature] += int(arr[5])
-                    features.add(feature)
-
-                    if self.do_filter:
-                        if int(arr[5]) < self.filter_thresh:
-                            continue
-                        items.append(arr)
-                    else:
-                        items.append(arr)
-            if not items:
-                continue
-
-            items = sorted(items, key=lambda x: x[-1], reverse=True)
 
-            fh2.write(f'{cb}\t' + '\t'.join(items[0]) + '\n')
+        with run_profile.stage('report', [], [fresult, freport, freportg]) as entry:
+            barcodes, species = self.braken_table('S')
+            entry['records'] = len(species)
+            # the species reports, the count matrix and the genus report run side by side
+            scheduler = Scheduler(self.p, 'report')
+            scheduler.add('species', lambda: self.species_report(barcodes, species, fresult, freport))
+            scheduler.add('matrix', lambda: self.write_matrix(barcodes, species), cpus=max(self.p - 1, 1))
+            scheduler.add('genus', lambda: self.genus_report(freportg))
+            scheduler.run()
+
+            self.report2()
+        return freport
 
-            for i, item in enumerate(items[0:5]):
-                if i == 0:
-                    fh1.write(f'{cb}\t' + '\t'.join(item) + '\n')
-                else:
-                    fh1.write('-\t' + '\t'.join(item) + '\n')
-        fh1.close()
-        fh2.close()
+    def species_report(self, barcodes, species, fresult, freport):
+        kept = species
+        if self.do_filter:
+            kept = species[species['new_est_reads'].values >= self.filter_thresh]
+        top = []
+        allot = []
+        for cell, rank, line in self.top_rows(kept, 5):
+            if rank == 0:
+                top.append(f'{barcodes[cell]}\t{line}\n')
+                allot.append(f'{barcodes[cell]}\t{line}\n')
+            else:
+                allot.append(f'-\t{line}\n')
+        with open(fresult, 'w') as fh1, open(freport, 'w') as fh2:
+            fh1.write("barcode\tname\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n")
+            fh2.write("barcode\tname\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n")
+            fh1.writelines(allot)
+            fh2.writelines(top)
+
+    def write_matrix(self, barcodes, species):
+        import pandas as pd
+
+        # the count matrix takes every species row, filtered or not
+        codes, features = pd.factorize(species['name'].str.replace(' ', '_'))
 
         outdir_raw = os.path.join(self.mat_dir, 'raw')
         dir_check(outdir_raw)
-        cMatrix = CountMatrix(bc_counts, features)
-        cMatrix.save_mex(outdir_raw)
-
-        for bout in os.listdir(self.braken_dir_g):
-            fbout = os.path.join(self.braken_dir_g, bout)
+        outputs = [os.path.join(outdir_raw, fname) for fname in ('matrix.mtx.gz', 'barcodes.tsv.gz', 'features.tsv.gz', 'matrix.bin')]
+        with run_profile.stage('matrix', [], outputs) as entry:
+            cMatrix = CountMatrix.from_arrays(codes, species['cell'].values, species['new_est_reads'].values, features, barcodes)
+            cMatrix.save_mex(outdir_raw, self.compresslevel, max(self.p - 1, 1))
+            cMatrix.save_binary(outdir_raw)
+            entry['records'] = int(cMatrix.m.nnz)
+
+    def genus_report(self, freportg):
+        barcodes, genus = self.braken_table('G')
+        genus = genus[genus['new_est_reads'].values >= 10]
+        with open(freportg, 'w') as fh3:
+            fh3.write("barcode\tname\ttaxonomy_id\ttaxonomy_lvl\tkraken_assigned_reads\tadded_reads\tnew_est_reads\tfraction_total_reads\n")
+            fh3.writelines(f'{barcodes[cell]}\t{line}\n' for cell, rank, line in self.top_rows(genus, 1))
+
+    def braken_table(self, level):
+        # every per-cell table of a level as one frame, `cell` indexing the returned barcodes
+        import pandas as pd
+
+        barcodes = []
+        sizes = []
+        lines = []
+        for cb, text in self.braken_records(level):
+            rows = text.splitlines()[1:]
+            if not rows:
+                continue
+            barcodes.append(cb)
+            sizes.append(len(rows))
+            lines.extend(rows)
+
+        if lines:
+            df = pd.read_csv(io.StringIO('\n'.join(lines)), sep='\t', header=None, names=BRAKEN_COLUMNS,
+                    quoting=csv.QUOTE_NONE, dtype={'name': str, 'taxonomy_id': str, 'taxonomy_lvl': str})
+        else:
+            df = pd.DataFrame(columns=BRAKEN_COLUMNS)
+        df['cell'] = np.repeat(np.arange(len(barcodes)), sizes)
+        df['line'] = [line.strip() for line in lines]
+        return barcodes, df
+
+    def top_rows(self, df, k):
+        # the k rows of highest fraction in every cell, cells in input order and ties in file order
+        cell = df['cell'].values.astype(np.int64)
+        fraction = df['fraction_total_reads'].values.astype(np.float64)
+        order = np.lexsort((-fraction, cell))
+        cell = cell[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(cell)) + 1]
+        rank = np.arange(cell.size) - np.repeat(starts, np.diff(np.r_[starts, cell.size]))
+        keep = rank < k
+        lines = df['line'].values[order[keep]]
+        return zip(cell[keep].tolist(), rank[keep].tolist(), lines.tolist())
+
+    def braken_records(self, level):
+        if self.store:
+            return RecordStore(os.path.join(self.store_dir, level)).items()
+        return self.braken_files(level)
+
+    def cell_record(self, cb, level='S'):
+        # one cell's bracken table (S, G), kraken report or bracken log, from the store or its own file
+        if self.store:
+            records = RecordStore(os.path.join(self.store_dir, level))
+            return records.get(cb) if cb in records else None
+        fnames = {
+                'S': [os.path.join(self.braken_dir, f'{cb}.braken')],
+                'G': [os.path.join(self.braken_dir_g, f'{cb}.G.braken')],
+                'kreport': [os.path.join(self.tmp_dir, f'{cb}.kreport')],
+                'log': [os.path.join(self.tmp_dir, f'{cb}.braken.log'), os.path.join(self.tmp_dir, f'{cb}.G.braken.log')],
+                }[level]
+        texts = []
+        for fname in fnames:
+            if os.path.exists(fname):
+                with open(fname) as fh:
+                    texts.append(fh.read())
+        return ''.join(texts) if texts else None
+
+    def braken_files(self, level):
+        braken_dir = self.braken_dir if level == 'S' else self.braken_dir_g
+        for bout in os.listdir(braken_dir):
+            fbout = os.path.join(braken_dir, bout)
             if not os.path.exists(fbout):
                 continue
             cb, *tmp = bout.split('.')
-            items = []
-            with open(fbout) as fh5:
-                fh5.readline()
-                for line in fh5:
-                    arr = line.strip().split('\t')
-                    if int(arr[5]) < 10:
-                        continue
-                    #if float(arr[-1]) < 0.05:
-                    #    continue
-                    items.append(arr)
-            items = sorted(items, key=lambda x: x[-1], reverse=True)
-            if not items:
-                continue
-
-            fh3.write(f'{cb}\t' + '\t'.join(items[0]) + '\n')
-        fh3.close()
-
-        self.report2()
-        return freport
+            with open(fbout) as fh:
+                yield cb, fh.read()
 
     def report2(self, cell_num='all'):
-        freport = os.path.join(self.res_dir, f'{self.sample}_sc_taxonomy.report')
-        freportg = os.path.join(self.res_dir, f'{self.sample}_sc_taxonomy.G.report')
-
-        fumi_ctx = os.path.join(self.data_dir, f'{self.sample}_UMI_counts.tsv')
-        reads_ctx = os.path.join(self.data_dir, f'{self.sample}_read_counts.tsv')
+        if cell_num != 'all':
+            self.report_cells([cell_num])
+            return
 
+        freport = os.path.join(self.res_dir, f'{self.sample}_sc_taxonomy.report')
+        import pandas as pd
         df = pd.read_csv(freport, header=0, index_col=0, sep='\t')
-        dfg = pd.read_csv(freportg, header=0, index_col=0, sep='\t')
+        self.pie_plot(df, cell_num)
+        self.violin_plot(df, cell_num)
 
-        if cell_num == 'all':
-            self.pie_plot(df, cell_num)
-            self.violin_plot(df, cell_num)
-            return
+    def report_cells(self, cell_nums):
+        # outputs of the top N barcodes by UMI for every N, sliced from data loaded once for the largest N
+        import pandas as pd
 
-        cells = set()
-        n = 0
+        cell_nums = sorted(set(cell_nums))
+        fumi_ctx = os.path.join(self.data_dir, f'{self.sample}_UMI_counts.tsv')
         with open(fumi_ctx) as fh:
-            for line in fh:
-                if n > cell_num:
-                    break
-                arr = line.split()
-                cells.add(arr[0])
-                n += 1
-        co_cells = cells & set(df.index)
-        co_cellsg = cells & set(dfg.index)
-
-        freport2 = os.path.join(self.res_dir, f'{self.sample}_sc_taxonomy_{cell_num}_bc.report')
-        freportg2 = os.path.join(self.res_dir, f'{self.sample}_sc_taxonomy_G_{cell_num}_bc.report')
-
-        df_cells = df.loc[list(co_cells), :]
-        dfg_cells = dfg.loc[list(co_cellsg), :]
-
-        df_cells.to_csv(freport2, sep='\t')
-        dfg_cells.to_csv(freportg2, sep='\t')
-
-        self.pie_plot(df_cells, cell_num)
-        self.violin_plot(df_cells, cell_num)
+            ranked = [line.split()[0] for _, line in zip(range(cell_nums[-1]), fh)]
+        rank = {cb: i for i, cb in enumerate(ranked)}
+
+        # report rows of the selected cells only, with the rank of their cell
+        tables = {}
+        for level, fname in (('S', f'{self.sample}_sc_taxonomy.report'), ('G', f'{self.sample}_sc_taxonomy.G.report')):
+            with open(os.path.join(self.res_dir, fname)) as fh:
+                header = fh.readline()
+                rows = [(rank[line.split('\t', 1)[0]], line) for line in fh if line.split('\t', 1)[0] in rank]
+            tables[level] = header, rows
+
+        raw = BinaryMatrix(os.path.join(self.mat_dir, 'raw', 'matrix.bin'))
+        raw_col = {cb: j for j, cb in enumerate(raw.barcodes)}
+        # raw column and selected position of every ranked cell with a column, in rank order
+        present = [(raw_col[cb], i) for i, cb in enumerate(ranked) if cb in raw_col]
+
+        for cell_num in cell_nums:
+            outdir = os.path.join(self.mat_dir, f'filtered_{cell_num}')
+            dir_check(outdir)
+            outputs = [os.path.join(outdir, fname) for fname in ('matrix.mtx.gz', 'barcodes.tsv.gz', 'features.tsv.gz', 'matrix.bin')]
+            with run_profile.stage(f'filtered_{cell_num}', [], outputs) as entry:
+                cols = np.array([j for j, i in present if i < cell_num], dtype=np.int64)
+                pos = np.array([i for j, i in present if i < cell_num], dtype=np.int64)
+                m = raw.cells(cols).tocoo()
+                # barcodes without a raw column stay in as empty cells
+                cMatrix = CountMatrix.from_arrays(m.row, pos[m.col], m.data, raw.features, ranked[:cell_num])
+                cMatrix.save_mex(outdir, self.compresslevel, self.p)
+                cMatrix.save_binary(outdir)
+                entry['records'] = int(cMatrix.m.nnz)
+
+            for level, name in (('S', 'sc_taxonomy'), ('G', 'sc_taxonomy_G')):
+                header, rows = tables[level]
+                with open(os.path.join(self.res_dir, f'{self.sample}_{name}_{cell_num}_bc.report'), 'w') as fh:
+                    fh.write(header)
+                    fh.writelines(line for i, line in rows if i < cell_num)
+
+            header, rows = tables['S']
+            text = header + ''.join(line for i, line in rows if i < cell_num)
+            df_cells = pd.read_csv(io.StringIO(text), header=0, index_col=0, sep='\t')
+            self.pie_plot(df_cells, cell_num)
+            self.violin_plot(df_cells, cell_num)
 
     def pie_plot(self, df, cell_num):
+        import matplotlib.pyplot as plt
+
         counts = Counter(df['name'].values)
         data = counts.values()
         names = counts.keys()
@@ -164,6 +247,9 @@ class Report:
 
 
     def violin_plot(self, df, cell_num):
+        import seaborn as sns
+        import matplotlib.pyplot as plt
+
         fig = plt.figure(figsize =(7, 8))
         ax = fig.subplots()
         sns.violinplot( y= df['fraction_total_reads'], inner='box', saturation=10)
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+
+
+class RunProfile:
+    # wall/cpu time, process peak rss so far and bytes in and out of every stage, saved as one json document per run
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        # task times and critical path of every Scheduler run, by scheduler name
+        self.schedules = {}
+        self.lock = threading.Lock()
+        # set to a directory to also dump a cProfile of every stage there
+        self.prof_dir = None
+        self.local = threading.local()
+
+    @contextmanager
+    def stage(self, name, inputs=(), outputs=()):
+        # the caller may add counts such as records to the yielded entry
+        entry = {'stage': name}
+        before = usage()
+        profiler = self.profiler()
+        try:
+            yield entry
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.local.profiling = False
+                profiler.dump_stats(os.path.join(self.prof_dir, f'{name}.prof'))
+            after = usage()
+            entry['start'] = round(before['wall'] - self.started, 3)
+            for key in ('wall', 'cpu', 'children_cpu'):
+                entry[key] = round(after[key] - before[key], 3)
+            # high-water marks of the whole run up to the end of the stage, not of the stage alone:
+            # a stage after the peak repeats it, and overlapping stages share it
+            entry['process_peak_rss_mb'] = after['process_peak_rss_mb']
+            entry['process_children_peak_rss_mb'] = after['process_children_peak_rss_mb']
+            entry['bytes_read'] = total_size(inputs)
+            entry['bytes_written'] = total_size(outputs)
+            self.add(entry)
+
+    def profiler(self):
+        # cProfile follows one thread, only the outermost stage of a thread is profiled
+        if self.prof_dir is None or getattr(self.local, 'profiling', False):
+            return None
+        os.makedirs(self.prof_dir, exist_ok=True)
+        self.local.profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def add(self, entry):
+        with self.lock:
+            self.stages.append(entry)
+
+    def add_schedule(self, name, summary):
+        # start times relative to the run, like those of the stages
+        for task in summary['tasks'].values():
+            task['start'] = round(task['start'] - self.started, 3)
+        with self.lock:
+            self.schedules[name] = summary
+
+    def save(self, fname):
+        doc = {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall': round(time.time() - self.started, 3),
+                'stages': self.stages,
+                'schedules': self.schedules,
+                }
+        with open(fname, 'w') as fh:
+            json.dump(doc, fh, indent=1)
+
+
+def usage():
+    # cpu counters are process wide, stages overlapping in time share them
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+            'wall': time.time(),
+            'cpu': own.ru_utime + own.ru_stime,
+            'children_cpu': children.ru_utime + children.ru_stime,
+            'process_peak_rss_mb': round(own.ru_maxrss / 1024, 1),
+            # the largest of the finished child processes
+            'process_children_peak_rss_mb': round(children.ru_maxrss / 1024, 1),
+            }
+
+
+def total_size(paths):
+    size = 0
+    for path in paths:
+        if path and os.path.isfile(path):
+            size += os.path.getsize(path)
+    return size
+
+
+run_profile = RunProfile()
@@ -0,0 +1,103 @@
+import time
+import queue
+import logging
+import threading
+
+from .runprofile import run_profile
+
+
+class Scheduler:
+    # runs each task in a thread once its dependencies are done and its cpus fit in the budget
+    def __init__(self, budget, name='pipeline'):
+        self.budget = max(int(budget), 1)
+        self.name = name
+        self.tasks = {}
+
+    def add(self, name, func, deps=(), cpus=1):
+        # a task wanting more than the whole budget runs alone, cpus=0 is background work outside the budget
+        self.tasks[name] = {
+                'func': func,
+                'deps': tuple(deps),
+                'cpus': min(max(int(cpus), 0), self.budget),
+                'start': None,
+                'end': None,
+                'after': None,
+                }
+
+    def ready(self, name):
+        return all(self.tasks[dep]['end'] is not None for dep in self.tasks[name]['deps'])
+
+    def run(self):
+        finished = queue.Queue()
+        pending = list(self.tasks)
+        running = set()
+        used = 0
+        last = None
+        error = None
+
+        def work(name):
+            try:
+                self.tasks[name]['func']()
+            except BaseException as e:
+                finished.put((name, e))
+            else:
+                finished.put((name, None))
+
+        while pending or running:
+            # a failed task stops new ones from starting, those already running are waited for
+            for name in list(pending) if error is None else ():
+                task = self.tasks[name]
+                if not self.ready(name):
+                    continue
+                if task['cpus'] and used + task['cpus'] > self.budget and used:
+                    continue
+                pending.remove(name)
+                running.add(name)
+                used += task['cpus']
+                task['start'] = time.time()
+                task['after'] = last
+                threading.Thread(target=work, args=(name,), name=name, daemon=True).start()
+            if not running:
+                break
+            name, e = finished.get()
+            task = self.tasks[name]
+            task['end'] = time.time()
+            running.remove(name)
+            used -= task['cpus']
+            last = name
+            if e is not None and error is None:
+                error = e
+
+        # recorded on failure too, the profile shows how far the tasks got
+        run_profile.add_schedule(self.name, self.summary())
+        if error is not None:
+            raise error
+        self.log()
+
+    def critical_path(self):
+        # back from the last task to finish, through whichever task let each one start
+        done = [name for name, task in self.tasks.items() if task['end'] is not None]
+        if not done:
+            return []
+        path = [max(done, key=lambda name: self.tasks[name]['end'])]
+        while self.tasks[path[-1]]['after'] is not None:
+            path.append(self.tasks[path[-1]]['after'])
+        return path[::-1]
+
+    def summary(self):
+        # task times and the critical path, as saved in the run profile
+        tasks = {name: {'cpus': task['cpus'], 'start': round(task['start'], 3), 'wall': round(task['end'] - task['start'], 3)}
+                for name, task in self.tasks.items() if task['end'] is not None}
+        path = self.critical_path()
+        wall = self.tasks[path[-1]]['end'] - self.tasks[path[0]]['start'] if path else 0.0
+        return {'tasks': tasks, 'critical_path': path, 'critical_wall': round(wall, 3)}
+
+    def log(self):
+        for name, task in self.tasks.items():
+            logging.info(f"{self.name}: {name} {task['end'] - task['start']:.1f}s")
+        path = self.critical_path()
+        if not path:
+            return
+        total = self.tasks[path[-1]]['end'] - self.tasks[path[0]]['start']
+        steps = ' > '.join(f"{name} {self.tasks[name]['end'] - self.tasks[name]['start']:.1f}s" for name in path)
+        logging.info(f'{self.name}: critical path {steps}, {total:.1f}s in all.')
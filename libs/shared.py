@@ -0,0 +1,50 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays:
+    def __init__(self, shm, spec):
+        self.shm = shm
+        self.spec = spec
+        self.arrays = {}
+        for key, (offset, dtype, shape) in spec.items():
+            self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+
+    @classmethod
+    def create(cls, arrays):
+        # one block for all arrays, each starting on a 64-byte boundary
+        spec = {}
+        size = 0
+        for key, arr in arrays.items():
+            arr = np.asarray(arr)
+            spec[key] = (size, arr.dtype.str, arr.shape)
+            size += (arr.nbytes + 63) // 64 * 64
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        obj = cls(shm, spec)
+        for key, arr in arrays.items():
+            obj.arrays[key][...] = arr
+        return obj
+
+    @classmethod
+    def attach(cls, name, spec):
+        return cls(shared_memory.SharedMemory(name=name), spec)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def close(self):
+        # views must be released before the mapping can be closed
+        self.arrays = {}
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
@@ -0,0 +1,96 @@
+import os
+import glob
+
+from .utils import dir_check
+
+
+class RecordWriter:
+    # appends records to <root>/part-N.rec and their key/offset/length to part-N.idx
+    def __init__(self, root, part_size=4 << 30):
+        self.root = root
+        # a new part is started once the current one passes part_size bytes
+        self.part_size = part_size
+        dir_check(root)
+        self.open_part()
+
+    def open_part(self):
+        n = 0
+        while os.path.exists(os.path.join(self.root, f'part-{n}.idx')):
+            n += 1
+        self.prefix = os.path.join(self.root, f'part-{n}')
+        self.rec = open(f'{self.prefix}.rec', 'ab')
+        self.idx = open(f'{self.prefix}.idx', 'a')
+        self.offset = self.rec.tell()
+        self.pending = []
+
+    def append(self, key, text):
+        data = text.encode()
+        self.rec.write(data)
+        self.pending.append(f'{key}\t{self.offset}\t{len(data)}\n')
+        self.offset += len(data)
+
+    def flush(self):
+        # records reach the disk before the index entries pointing at them
+        self.rec.flush()
+        self.idx.writelines(self.pending)
+        self.idx.flush()
+        self.pending = []
+        if self.offset >= self.part_size:
+            self.rec.close()
+            self.idx.close()
+            self.open_part()
+
+    def close(self):
+        self.flush()
+        self.rec.close()
+        self.idx.close()
+
+
+class RecordStore:
+    def __init__(self, root):
+        self.root = root
+        self.index = {}
+        for fidx in sorted(glob.glob(os.path.join(root, 'part-*.idx')), key=part_number):
+            prefix = fidx[:-len('.idx')]
+            with open(fidx) as fh:
+                for line in fh:
+                    key, offset, length = line.rstrip('\n').split('\t')
+                    # later parts supersede earlier records of the same key
+                    self.index[key] = (prefix, int(offset), int(length))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, key):
+        prefix, offset, length = self.index[key]
+        with open(f'{prefix}.rec', 'rb') as fh:
+            fh.seek(offset)
+            return fh.read(length).decode()
+
+    def items(self, chunk=64 << 20):
+        # each part file read front to back in large chunks, not the whole part at once
+        parts = {}
+        for key, (prefix, offset, length) in self.index.items():
+            parts.setdefault(prefix, []).append((offset, length, key))
+        for prefix, records in parts.items():
+            records.sort()
+            with open(f'{prefix}.rec', 'rb') as fh:
+                base = 0
+                data = b''
+                for offset, length, key in records:
+                    if offset + length > base + len(data):
+                        fh.seek(offset)
+                        base = offset
+                        data = fh.read(max(chunk, length))
+                    yield key, data[offset - base:offset - base + length].decode()
+
+
+def part_number(fname):
+    name = os.path.basename(fname)
+    return int(name[len('part-'):name.index('.')])
@@ -0,0 +1,160 @@
+import os
+import stat
+import time
+import threading
+import subprocess as sp
+from multiprocessing import Pool
+
+
+class Stream:
+    # pipeline stages connected through named pipes, kept artifacts are teed to disk
+    def __init__(self):
+        self.fifos = []
+        self.kept = []
+        self.procs = []
+        self.threads = []
+        self.errors = []
+        self.pools = []
+        self.lock = threading.Lock()
+
+    def fifo(self, path):
+        if os.path.lexists(path):
+            os.remove(path)
+        os.mkfifo(path)
+        self.fifos.append(path)
+        return path
+
+    def keep(self, path):
+        # written next to the pipe and moved over it once the stream is done
+        part = f'{path}.part'
+        self.kept.append((part, path))
+        return part
+
+    def pool(self, process):
+        # create it before any pipe is opened, forked workers would otherwise hold pipe ends open
+        pool = Pool(max(process, 1))
+        self.pools.append(pool)
+        return pool
+
+    def spawn(self, name, cmd):
+        self.procs.append((name, sp.Popen(cmd)))
+
+    def thread(self, name, target, *args):
+        def run():
+            try:
+                target(*args)
+            except Exception as e:
+                self.errors.append(f'{name}: {e!r}')
+
+        t = threading.Thread(target=run, name=name, daemon=True)
+        t.start()
+        self.threads.append(t)
+
+    def pump(self, name, src, dsts):
+        self.thread(name, copy_stream, src, dsts)
+
+    def release(self, path):
+        # completes a pending open on either end of the pipe, so nothing waits on a stage that is gone
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        except OSError:
+            return
+        os.close(fd)
+
+    def failures(self):
+        errors = list(self.errors)
+        for name, p in self.procs:
+            if p.poll():
+                errors.append(f'{name} exited with code {p.returncode}')
+        return errors
+
+    def done(self):
+        return all(p.poll() is not None for _, p in self.procs) and not any(t.is_alive() for t in self.threads)
+
+    def watch(self, poll=1):
+        # stops every stage as soon as one fails, so the consumer is not left waiting on its input
+        def run():
+            while not self.done():
+                if self.failures():
+                    self.abort()
+                    return
+                time.sleep(poll)
+
+        threading.Thread(target=run, name='watch', daemon=True).start()
+
+    def wait(self, sinks=(), poll=1):
+        # sinks are the pipes read by a consumer that has already finished
+        while True:
+            for path in sinks:
+                self.release(path)
+            errors = self.failures()
+            if errors:
+                self.abort()
+                raise RuntimeError('streaming stage failed: ' + '; '.join(errors))
+            if self.done():
+                break
+            time.sleep(poll)
+        self.close()
+
+    def abort(self):
+        with self.lock:
+            for name, p in self.procs:
+                if p.poll() is None:
+                    p.terminate()
+            for path in self.fifos:
+                self.release(path)
+            for name, p in self.procs:
+                p.wait()
+            for pool in self.pools:
+                pool.terminate()
+            self.pools = []
+            for t in self.threads:
+                t.join(5)
+            for part, path in self.kept:
+                if os.path.exists(part):
+                    os.remove(part)
+            self.kept = []
+            self.remove_fifos()
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools:
+                pool.close()
+                pool.join()
+            self.pools = []
+            for part, path in self.kept:
+                os.replace(part, path)
+            self.kept = []
+            self.remove_fifos()
+
+    def remove_fifos(self):
+        for path in self.fifos:
+            if os.path.lexists(path) and stat.S_ISFIFO(os.lstat(path).st_mode):
+                os.remove(path)
+        self.fifos = []
+
+
+def copy_stream(src, dsts, block=1 << 20):
+    with open(src, 'rb') as fin:
+        outs = [open(dst, 'wb') for dst in dsts]
+        try:
+            while True:
+                data = fin.read(block)
+                if not data:
+                    break
+                for out in outs:
+                    out.write(data)
+        finally:
+            for out in outs:
+                out.close()
+
+
+def write_stream(batches, dsts):
+    outs = [open(dst, 'wb') for dst in dsts]
+    try:
+        for data in batches:
+            for out in outs:
+                out.write(data)
+    finally:
+        for out in outs:
+            out.close()
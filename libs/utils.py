@@ -10,6 +10,11 @@ def dir_check(dirname):
 def file_check(filename):
     return os.path.isfile(filename)
 
+def is_on(value):
+    if not value:
+        return False
+    return value.lower() in ('1', 'on', 'yes', 'true')
+
 def read_config(configfile):
     config = {}
     with open(configfile) as fh:
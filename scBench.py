@@ -0,0 +1,8 @@
+import os
+import sys
+
+from bench.run import main
+
+
+if __name__ == '__main__':
+    main()
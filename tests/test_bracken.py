@@ -0,0 +1,106 @@
+import os
+import shutil
+import subprocess as sp
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from libs.bracken import Bracken
+from libs.classify import Taxanomy
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bracken')
+KREPORT = os.path.join(DATA, 'sample.kreport')
+
+
+def native_report(level):
+    # the fixture report as a single cell, clade and direct counts from its own columns
+    taxan = Taxanomy(KREPORT)
+    with open(KREPORT) as fh:
+        rows = [line.split('\t') for line in fh]
+    clade = sparse.csr_matrix(np.array([[int(row[1]) for row in rows]], dtype=np.int64))
+    direct = sparse.csr_matrix(np.array([[int(row[2]) for row in rows]], dtype=np.int64))
+    reports = list(Bracken(taxan, DATA).reports(direct, clade, level))
+    assert len(reports) == 1
+    return reports[0][1]
+
+
+def small_bracken(tmp_path):
+    # one genus with two species, the first keeping half of its own kmers
+    with open(tmp_path / 'sample.kreport', 'w') as fh:
+        fh.write('100.00\t0\t0\tR\t1\troot\n'
+                '100.00\t0\t0\tG\t10\t  Genus alpha\n'
+                '50.00\t0\t0\tS\t11\t    Genus alpha one\n'
+                '50.00\t0\t0\tS\t12\t    Genus alpha two\n')
+    with open(tmp_path / 'database100mers.kmer_distrib', 'w') as fh:
+        fh.write('mapped_taxid\tgenome_taxids:kmers_mapped:total_genome_kmers\n'
+                '10\t11:100:1000 12:300:1000\n'
+                '11\t11:500:1000\n'
+                '12\t12:1000:1000\n')
+    taxan = Taxanomy(str(tmp_path / 'sample.kreport'))
+    return taxan, Bracken(taxan, str(tmp_path))
+
+
+def cell_counts(taxan, cells):
+    # direct reads per cell as {tax_id: reads}, clade reads summed up the lineage
+    n = len(taxan.tax_ids)
+    direct = np.zeros((len(cells), n), dtype=np.int64)
+    for c, reads in enumerate(cells):
+        for tax_id, count in reads.items():
+            direct[c, taxan.index[tax_id]] = count
+    clade = direct.copy()
+    clade[:, taxan.index['10']] += direct[:, [taxan.index['11'], taxan.index['12']]].sum(axis=1)
+    clade[:, taxan.index['1']] += clade[:, taxan.index['10']]
+    return sparse.csr_matrix(direct), sparse.csr_matrix(clade)
+
+
+def test_estimate_redistribution(tmp_path):
+    taxan, bracken = small_bracken(tmp_path)
+    # cell 1 has nothing above the species to share and its second species is under the threshold
+    direct, clade = cell_counts(taxan, [{'10': 20, '11': 10, '12': 30}, {'11': 12, '12': 5}])
+    cell, node, reads, added, new_reads, fraction = bracken.estimate(direct, clade, 'S')
+
+    # genome reads 10 / 0.5 and 30 / 1, so the genus reads split 0.1 * 20 : 0.3 * 30
+    share = 20 * 2 / 11
+    assert cell.tolist() == [0, 0, 1]
+    assert [taxan.tax_ids[i] for i in node.tolist()] == ['11', '12', '11']
+    assert reads.tolist() == [10, 30, 12]
+    assert added.tolist() == [3, 16, 0]
+    assert new_reads.tolist() == [13, 46, 12]
+    assert np.allclose(fraction, [(10 + share) / 60, (50 - share) / 60, 1])
+
+
+def test_estimate_nothing_to_redistribute(tmp_path):
+    taxan, bracken = small_bracken(tmp_path)
+    direct, clade = cell_counts(taxan, [{'11': 12, '12': 36}])
+    cell, node, reads, added, new_reads, fraction = bracken.estimate(direct, clade, 'S')
+    assert added.tolist() == [0, 0]
+    assert new_reads.tolist() == [12, 36]
+    assert np.allclose(fraction, [0.25, 0.75])
+
+
+def table(text):
+    # bracken's row order among equal estimates is not fixed
+    lines = text.splitlines()
+    return lines[0], sorted(lines[1:])
+
+
+@pytest.mark.parametrize('level', ['S', 'G'])
+def test_native_matches_expected(level):
+    with open(os.path.join(DATA, f'expected_{level}.bracken')) as fh:
+        assert table(native_report(level)) == table(fh.read())
+
+
+@pytest.mark.parametrize('level', ['S', 'G'])
+def test_native_matches_bracken(level, tmp_path):
+    bracken = os.environ.get('BRACKEN') or shutil.which('bracken')
+    if not bracken:
+        pytest.skip('bracken not found, set BRACKEN to its path')
+    # bracken writes a report next to its input, so it runs on a copy
+    for fname in ('sample.kreport', 'database100mers.kmer_distrib'):
+        shutil.copy(os.path.join(DATA, fname), tmp_path)
+    output = tmp_path / f'sample.{level}.bracken'
+    sp.run([bracken, '-d', str(tmp_path), '-i', str(tmp_path / 'sample.kreport'), '-o', str(output),
+        '-r', '100', '-l', level, '-t', '10'], check=True, capture_output=True)
+    assert table(native_report(level)) == table(output.read_text())
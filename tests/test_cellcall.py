@@ -0,0 +1,31 @@
+import numpy as np
+
+from libs.cellcall import call_cells
+
+
+def negative_binomial(rng, mean, size, n):
+    return rng.negative_binomial(size, size / (size + mean), n)
+
+
+def test_small_cells_recall():
+    # 2000 large cells, 1500 small cells well clear of the empties and 100k empty droplets
+    rng = np.random.default_rng(0)
+    large = negative_binomial(rng, 5000, 10, 2000)
+    small = negative_binomial(rng, 300, 50, 1500)
+    empty = negative_binomial(rng, 20, 2, 100000)
+    result = call_cells(np.concatenate([large, small, empty]), lower=100, fdr=0.01)
+
+    # the knee takes the large cells, the small ones are left to the tail test
+    assert 1900 <= result['knee_cells'] <= 2100
+    assert result['knee_cells'] + result['tail_cells'] == result['cells']
+    assert result['cells'] >= 2000 + 0.95 * 1500
+    # the empties reaching past `lower` are only called at about the fdr
+    assert result['cells'] <= 3500 * 1.02
+
+
+def test_no_tail_without_candidates():
+    rng = np.random.default_rng(1)
+    counts = np.concatenate([negative_binomial(rng, 5000, 10, 500), negative_binomial(rng, 20, 5, 20000)])
+    result = call_cells(counts, lower=100, fdr=0.01)
+    assert result['tail_cells'] <= 5
+    assert 480 <= result['cells'] <= 505